@@ -94,6 +94,24 @@ flags.DEFINE_float(
     'or downsampled.')
 
 flags.DEFINE_integer('output_shards', None, 'Number of output shards.')
+flags.DEFINE_integer(
+    'max_pairs_per_location',
+    None,
+    (
+        'Maximum number of (before, after) image pairs to generate examples '
+        'for at each location. Pairs with the best alignment scores are used '
+        'first. If unset, generates examples for all pairs.'
+    ),
+)
+flags.DEFINE_integer(
+    'large_patch_jpeg_quality',
+    None,
+    (
+        'If set, encode large image patches as JPEG with this quality (e.g. '
+        '90) instead of PNG. Large patches are only used for labeling, so '
+        'lossy encoding makes them much smaller and faster to write.'
+    ),
+)
 flags.DEFINE_list(
     'gdal_env',
     None,
@@ -254,7 +272,9 @@ def main(args):
       config.cloud_region,
       config.worker_service_account,
       config.max_dataflow_workers,
-      config.cloud_detector_model_path
+      config.cloud_detector_model_path,
+      config.max_pairs_per_location,
+      config.large_patch_jpeg_quality,
   )
 
 
@@ -58,6 +58,9 @@ LABEL_SCHEMA_URI = ('gs://google-cloud-aiplatform/schema/datalabelingjob/'
 Example = tf.train.Example
 Image = PIL.Image.Image
 
+# Every JPEG file starts with this start-of-image marker.
+_JPEG_SIGNATURE = b'\xff\xd8'
+
 
 def _get_api_endpoint(cloud_location: str) -> str:
   return f'{cloud_location}-aiplatform.googleapis.com'
@@ -93,6 +96,12 @@ def _annotate_image(image: Image, caption: str) -> Image:
   return annotated_image
 
 
+def _deserialize_large_image(image_bytes: bytes) -> Image:
+  """Deserializes a large image patch, which may be PNG or JPEG encoded."""
+  image_format = 'jpeg' if image_bytes.startswith(_JPEG_SIGNATURE) else 'png'
+  return utils.deserialize_image(image_bytes, image_format)
+
+
 def _read_example_ids_from_import_file(path: str) -> Iterable[str]:
   with tf.io.gfile.GFile(path, 'r') as import_file:
     for line in import_file:
@@ -278,12 +287,10 @@ def _create_labeling_images_from_example_file(
       logging.info('"%s" excluded', example_id)
       continue
 
-    before_image = utils.deserialize_image(
-        example.features.feature['pre_image_png_large'].bytes_list.value[0],
-        'png')
-    after_image = utils.deserialize_image(
-        example.features.feature['post_image_png_large'].bytes_list.value[0],
-        'png')
+    before_image = _deserialize_large_image(
+        example.features.feature['pre_image_png_large'].bytes_list.value[0])
+    after_image = _deserialize_large_image(
+        example.features.feature['post_image_png_large'].bytes_list.value[0])
     labeling_image = create_labeling_image(
         before_image, after_image, example_id, plus_code)
     labeling_image_bytes = utils.serialize_image(labeling_image, 'png')
@@ -21,8 +21,8 @@ import itertools
 import json
 import logging
 import os
-import pickle
 import struct
+import warnings
 from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import apache_beam as beam
@@ -59,6 +59,11 @@ _MAX_DISPLACEMENT = 30
 # Code length generated by openlocationcode module.
 _PLUS_CODE_LENGTH = 14
 
+# zlib compression level for PNG encoding of image patches. Level 1 is several
+# times faster than the default level while producing only slightly larger
+# files.
+_PNG_COMPRESSION_LEVEL = 1
+
 
 @dataclasses.dataclass
 class ExamplesGenerationConfig:
@@ -100,6 +105,8 @@ class ExamplesGenerationConfig:
   num_keep_labeled_examples: int = None
   configuration_path: Optional[str] = None
   cloud_detector_model_path: Optional[str] = None
+  max_pairs_per_location: Optional[int] = None
+  large_patch_jpeg_quality: Optional[int] = None
 
   # TODO(mohammedelfatihsalah): Add a type for flagvalues argument in init_from_flags.
   @staticmethod
@@ -189,6 +196,216 @@ class _FeatureUnion:
   after_image: Tuple[str, np.ndarray] = None
 
 
+@dataclasses.dataclass
+class _GroupedFeatures:
+  """All features collected for an example.
+
+  Attributes:
+    scalar_features: Dictionary mapping string feature names to lists of scalar
+        values (floats, ints, or strings).
+    before_images: List of (image_path, image array) tuples of before images.
+    after_images: List of (image_path, image array) tuples of after images.
+  """
+  scalar_features: Dict[str, Any] = dataclasses.field(default_factory=dict)
+  before_images: List[Tuple[str, np.ndarray]] = dataclasses.field(
+      default_factory=list
+  )
+  after_images: List[Tuple[str, np.ndarray]] = dataclasses.field(
+      default_factory=list
+  )
+
+
+_IMAGE_HEADER = struct.Struct('<IBB')
+
+
+def _append_encoded_images(
+    images: List[Tuple[str, np.ndarray]], parts: List[bytes]
+) -> None:
+  """Appends the encoding of a list of (image_path, image array) to parts.
+
+  Each image is written as a header with the path, dtype and shape followed by
+  the raw array buffer, so no pickling is involved.
+
+  Args:
+    images: List of (image path, image array) tuples.
+    parts: List of byte strings to append to.
+  """
+  parts.append(struct.pack('<I', len(images)))
+  for path, image in images:
+    path_bytes = path.encode()
+    dtype_bytes = image.dtype.str.encode()
+    parts.append(
+        _IMAGE_HEADER.pack(len(path_bytes), len(dtype_bytes), image.ndim)
+    )
+    parts.append(path_bytes)
+    parts.append(dtype_bytes)
+    parts.append(struct.pack(f'<{image.ndim}I', *image.shape))
+    parts.append(memoryview(np.ascontiguousarray(image)).cast('B'))
+
+
+def _decode_images(
+    encoded: bytes, offset: int
+) -> Tuple[List[Tuple[str, np.ndarray]], int]:
+  """Decodes images written by _append_encoded_images.
+
+  Args:
+    encoded: Encoded bytes.
+    offset: Offset in encoded at which the images start.
+
+  Returns:
+    Tuple of the list of (image path, image array) tuples and the offset just
+    past the decoded images. The arrays are read-only views into encoded.
+  """
+  (num_images,) = struct.unpack_from('<I', encoded, offset)
+  offset += 4
+  images = []
+  for _ in range(num_images):
+    path_length, dtype_length, ndim = _IMAGE_HEADER.unpack_from(
+        encoded, offset
+    )
+    offset += _IMAGE_HEADER.size
+    path = encoded[offset:offset + path_length].decode()
+    offset += path_length
+    dtype = np.dtype(encoded[offset:offset + dtype_length].decode())
+    offset += dtype_length
+    shape = struct.unpack_from(f'<{ndim}I', encoded, offset)
+    offset += 4 * ndim
+    image = np.frombuffer(
+        encoded, dtype=dtype, count=int(np.prod(shape)), offset=offset
+    ).reshape(shape)
+    offset += image.nbytes
+    images.append((path, image))
+  return images, offset
+
+
+def _encode_features(
+    scalar_features: Optional[Dict[str, Any]],
+    before_images: List[Tuple[str, np.ndarray]],
+    after_images: List[Tuple[str, np.ndarray]],
+    scalar_coder: beam.coders.Coder,
+) -> bytes:
+  parts = []
+  encoded_scalar_features = scalar_coder.encode(scalar_features)
+  parts.append(struct.pack('<I', len(encoded_scalar_features)))
+  parts.append(encoded_scalar_features)
+  _append_encoded_images(before_images, parts)
+  _append_encoded_images(after_images, parts)
+  return b''.join(parts)
+
+
+def _decode_features(
+    encoded: bytes, scalar_coder: beam.coders.Coder
+) -> Tuple[
+    Optional[Dict[str, Any]],
+    List[Tuple[str, np.ndarray]],
+    List[Tuple[str, np.ndarray]],
+]:
+  (scalar_features_length,) = struct.unpack_from('<I', encoded, 0)
+  offset = 4 + scalar_features_length
+  scalar_features = scalar_coder.decode(encoded[4:offset])
+  before_images, offset = _decode_images(encoded, offset)
+  after_images, _ = _decode_images(encoded, offset)
+  return scalar_features, before_images, after_images
+
+
+class _FeatureUnionCoder(beam.coders.Coder):
+  """Coder for _FeatureUnion that stores image arrays as raw bytes."""
+
+  def __init__(self):
+    self._scalar_coder = beam.coders.FastPrimitivesCoder()
+
+  def encode(self, value: _FeatureUnion) -> bytes:
+    return _encode_features(
+        value.scalar_features,
+        [value.before_image] if value.before_image else [],
+        [value.after_image] if value.after_image else [],
+        self._scalar_coder,
+    )
+
+  def decode(self, encoded: bytes) -> _FeatureUnion:
+    scalar_features, before_images, after_images = _decode_features(
+        encoded, self._scalar_coder
+    )
+    return _FeatureUnion(
+        scalar_features=scalar_features,
+        before_image=before_images[0] if before_images else None,
+        after_image=after_images[0] if after_images else None,
+    )
+
+  def is_deterministic(self) -> bool:
+    return False
+
+  def to_type_hint(self):
+    return _FeatureUnion
+
+
+class _GroupedFeaturesCoder(beam.coders.Coder):
+  """Coder for _GroupedFeatures that stores image arrays as raw bytes."""
+
+  def __init__(self):
+    self._scalar_coder = beam.coders.FastPrimitivesCoder()
+
+  def encode(self, value: _GroupedFeatures) -> bytes:
+    return _encode_features(
+        value.scalar_features,
+        value.before_images,
+        value.after_images,
+        self._scalar_coder,
+    )
+
+  def decode(self, encoded: bytes) -> _GroupedFeatures:
+    return _GroupedFeatures(*_decode_features(encoded, self._scalar_coder))
+
+  def is_deterministic(self) -> bool:
+    return False
+
+  def to_type_hint(self):
+    return _GroupedFeatures
+
+
+beam.coders.registry.register_coder(_FeatureUnion, _FeatureUnionCoder)
+beam.coders.registry.register_coder(_GroupedFeatures, _GroupedFeaturesCoder)
+
+
+class _FeatureUnionCombineFn(beam.CombineFn):
+  """Combines all _FeatureUnions of an example into a _GroupedFeatures.
+
+  Unlike GroupByKey, this lets the runner partially combine features before the
+  shuffle.
+  """
+
+  def create_accumulator(self) -> _GroupedFeatures:
+    return _GroupedFeatures()
+
+  def add_input(
+      self, accumulator: _GroupedFeatures, feature: _FeatureUnion
+  ) -> _GroupedFeatures:
+    if feature.scalar_features:
+      accumulator.scalar_features.update(feature.scalar_features)
+    elif feature.before_image:
+      accumulator.before_images.append(feature.before_image)
+    elif feature.after_image:
+      accumulator.after_images.append(feature.after_image)
+    return accumulator
+
+  def merge_accumulators(
+      self, accumulators: Iterable[_GroupedFeatures]
+  ) -> _GroupedFeatures:
+    accumulators = iter(accumulators)
+    merged = next(accumulators)
+    for accumulator in accumulators:
+      merged.scalar_features.update(accumulator.scalar_features)
+      merged.before_images.extend(accumulator.before_images)
+      merged.after_images.extend(accumulator.after_images)
+    return merged
+
+  def extract_output(self, accumulator: _GroupedFeatures) -> _GroupedFeatures:
+    return accumulator
+
+  def get_accumulator_coder(self) -> beam.coders.Coder:
+    return _GroupedFeaturesCoder()
+
+
 class NoBuildingFoundError(Exception):
   """Raised when no building found in the area of interest."""
 
@@ -256,7 +473,12 @@ def _to_grayscale(image: np.ndarray) -> np.ndarray:
   return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
 
 
-def align_after_image(before_image: np.ndarray, after_image: np.ndarray):
+def align_after_image(
+    before_image: np.ndarray,
+    after_image: np.ndarray,
+    before_gray: Optional[np.ndarray] = None,
+    after_gray: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, float]:
   """Aligns after image to before image.
 
   Uses OpenCV template matching algorithm to align before and after
@@ -264,29 +486,45 @@ def align_after_image(before_image: np.ndarray, after_image: np.ndarray):
   alignment can be found. If the two images are the same size, then obviously no
   alignment is possible.
 
+  Only alignments that displace the before image at most _MAX_DISPLACEMENT
+  pixels from the center of the after image in either dimension are considered.
+
   Args:
     before_image: Before image.
     after_image: After image.
+    before_gray: Grayscale version of before_image. Computed if not provided.
+    after_gray: Grayscale version of after_image. Computed if not provided.
 
   Returns:
-    A crop of after_image that is the same size as before_image and is best
-    aligned to it.
+    A tuple of a crop of after_image that is the same size as before_image and
+    is best aligned to it, and the template matching score of that alignment.
+    Scores range from -1 to 1, where higher is better.
   """
-  result = cv2.matchTemplate(
-      _to_grayscale(after_image), _to_grayscale(before_image),
-      _ALIGNMENT_METHOD)
-  _, _, _, max_location = cv2.minMaxLoc(result)
-  j, i = max_location
+  if before_gray is None:
+    before_gray = _to_grayscale(before_image)
+  if after_gray is None:
+    after_gray = _to_grayscale(after_image)
   rows = before_image.shape[0]
   cols = before_image.shape[1]
+  top = max(0, (after_image.shape[0] - rows) // 2 - _MAX_DISPLACEMENT)
+  left = max(0, (after_image.shape[1] - cols) // 2 - _MAX_DISPLACEMENT)
+  search_region = after_gray[
+      top:top + rows + 2 * _MAX_DISPLACEMENT,
+      left:left + cols + 2 * _MAX_DISPLACEMENT,
+  ]
+  result = cv2.matchTemplate(search_region, before_gray, _ALIGNMENT_METHOD)
+  _, max_score, _, max_location = cv2.minMaxLoc(result)
+  j, i = max_location
+  i += top
+  j += left
   aligned_after = after_image[i:i + rows, j:j + cols, :]
-  return aligned_after
+  return aligned_after, max_score
 
 
 def _mostly_blank(image: np.ndarray) -> bool:
   """Determines if an image is mostly blank.
 
-  Assumes that the first dimension of the input data is the channel dimension. A
+  Assumes that the last dimension of the input data is the channel dimension. A
   pixel is considered blank if it has 0s in all channels.
 
   Args:
@@ -296,11 +534,16 @@ def _mostly_blank(image: np.ndarray) -> bool:
     Whether the image has too many blank pixels.
   """
   if image.size == 0:
-    return 0
-
-  flattened = image.max(axis=0)
-  num_non_blank = np.count_nonzero(flattened)
-  blank_fraction = (flattened.size - num_non_blank) / flattened.size
+    return False
+
+  num_pixels = image.shape[0] * image.shape[1]
+  # Combining the channel planes elementwise is several times faster than
+  # image.any(axis=-1), which reduces over the short strided channel axis.
+  non_blank = image[..., 0] != 0
+  for channel in range(1, image.shape[-1]):
+    non_blank |= image[..., channel] != 0
+  num_non_blank = np.count_nonzero(non_blank)
+  blank_fraction = (num_pixels - num_non_blank) / num_pixels
   return blank_fraction >= _BLANK_THRESHOLD
 
 
@@ -321,6 +564,51 @@ def _center_crop(image: np.ndarray, crop_size: int) -> np.ndarray:
   return image[i:i + crop_size, j:j + crop_size, :]
 
 
+def _encode_png(image: np.ndarray) -> bytes:
+  """Encodes an RGB image as PNG.
+
+  Args:
+    image: RGB image array.
+
+  Returns:
+    PNG encoded bytes.
+
+  Raises:
+    ValueError: If the image could not be encoded.
+  """
+  success, encoded = cv2.imencode(
+      '.png',
+      cv2.cvtColor(image, cv2.COLOR_RGB2BGR),
+      [cv2.IMWRITE_PNG_COMPRESSION, _PNG_COMPRESSION_LEVEL],
+  )
+  if not success:
+    raise ValueError(f'Failed to encode image of shape {image.shape} as PNG.')
+  return encoded.tobytes()
+
+
+def _encode_jpeg(image: np.ndarray, quality: int) -> bytes:
+  """Encodes an RGB image as JPEG.
+
+  Args:
+    image: RGB image array.
+    quality: JPEG quality, from 0 to 100.
+
+  Returns:
+    JPEG encoded bytes.
+
+  Raises:
+    ValueError: If the image could not be encoded.
+  """
+  success, encoded = cv2.imencode(
+      '.jpg',
+      cv2.cvtColor(image, cv2.COLOR_RGB2BGR),
+      [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1],
+  )
+  if not success:
+    raise ValueError(f'Failed to encode image of shape {image.shape} as JPEG.')
+  return encoded.tobytes()
+
+
 def _make_example_id(longitude: float, latitude: float, before_image_id: str,
                      after_image_id: str) -> str:
   """Hashes the uniquely identifying features of an example into a string id.
@@ -332,11 +620,17 @@ def _make_example_id(longitude: float, latitude: float, before_image_id: str,
     after_image_id: Id of after image.
 
   Returns:
-    String hash of input features.
+    128 bit hex string hash of input features.
   """
-  serialized = pickle.dumps(
-      (longitude, latitude, before_image_id, after_image_id))
-  return hashlib.md5(serialized).hexdigest()
+  # Image ids are paths, which cannot contain null bytes, so the separator
+  # keeps different splits of the same characters from colliding.
+  serialized = b''.join([
+      struct.pack('<dd', longitude, latitude),
+      before_image_id.encode(),
+      b'\x00',
+      after_image_id.encode(),
+  ])
+  return hashlib.blake2b(serialized, digest_size=16).hexdigest()
 
 
 def _make_int64_id(example_id: str) -> int:
@@ -369,6 +663,11 @@ class GenerateExamplesFn(beam.DoFn):
     _example_patch_size: Size in pixels of the smaller before and after image
       patches used in TF Examples. This is typically 64.
     _use_before_image: Whether to include before images in the examples.
+    _max_pairs_per_location: Maximum number of (before, after) image pairs to
+      generate examples for at each location. Pairs with the best alignment
+      scores are used first. If None, examples are generated for all pairs.
+    _large_patch_jpeg_quality: If set, large image patches are JPEG encoded
+      with this quality instead of PNG encoded. The feature names are kept.
   """
 
   def __init__(
@@ -377,11 +676,15 @@ class GenerateExamplesFn(beam.DoFn):
       example_patch_size: int,
       use_before_image: bool,
       cloud_detector_model_path: Optional[str] = None,
+      max_pairs_per_location: Optional[int] = None,
+      large_patch_jpeg_quality: Optional[int] = None,
   ) -> None:
     self._cloud_detector_model_path = cloud_detector_model_path
     self._large_patch_size = large_patch_size
     self._example_patch_size = example_patch_size
     self._use_before_image = use_before_image
+    self._max_pairs_per_location = max_pairs_per_location
+    self._large_patch_jpeg_quality = large_patch_jpeg_quality
 
     self._example_count = Metrics.counter('skai', 'generated_examples_count')
     self._bad_example_count = Metrics.counter('skai', 'rejected_examples_count')
@@ -398,6 +701,27 @@ class GenerateExamplesFn(beam.DoFn):
     else:
       self.cloud_detector = None
 
+    # Placeholder before image used for all examples when before images are
+    # not used. It is shared, so it is made read-only to guard against
+    # accidental modification.
+    self._blank_before_image = np.zeros(
+        (self._large_patch_size, self._large_patch_size, 3), dtype=np.uint8
+    )
+    self._blank_before_image.flags.writeable = False
+    # Every example without a before image gets the same encoded placeholder
+    # patches, so encode them just once.
+    self._blank_before_png = _encode_png(
+        _center_crop(self._blank_before_image, self._example_patch_size)
+    )
+    self._blank_before_large_bytes = self._encode_large_patch(
+        self._blank_before_image
+    )
+
+  def _encode_large_patch(self, image: np.ndarray) -> bytes:
+    if self._large_patch_jpeg_quality is None:
+      return _encode_png(image)
+    return _encode_jpeg(image, self._large_patch_jpeg_quality)
+
   def _create_example(
       self,
       encoded_coordinates: str,
@@ -405,22 +729,23 @@ class GenerateExamplesFn(beam.DoFn):
       before_image: np.ndarray,
       after_image_id: str,
       after_image: np.ndarray,
-      scalar_features: Dict[str, List[Union[float, str]]]) -> Optional[Example]:
-    """Create Tensorflow Example from inputs.
+      scalar_features: Dict[str, List[Union[float, str]]]
+  ) -> Optional[Tuple[Example, Example]]:
+    """Create Tensorflow Examples from inputs.
 
     Args:
       encoded_coordinates: Encoded coordinates.
       before_image_id: String identifier for before image.
       before_image: Before disaster image.
       after_image_id: String identifier for after image.
-      after_image: After disaster image.
+      after_image: After disaster image, already aligned to the before image.
       scalar_features: Dict mapping scalar feature names to values.
 
     Returns:
-      Tensorflow Example.
+      Tuple of small and large Tensorflow Examples, or None if the images are
+      mostly blank. The large example has the same features as the small
+      example plus the large before and after image patches.
     """
-    if self._use_before_image:
-      after_image = align_after_image(before_image, after_image)
     before_crop = _center_crop(before_image, self._example_patch_size)
     if self._use_before_image and _mostly_blank(before_crop):
       self._before_patch_blank_count.inc()
@@ -432,6 +757,13 @@ class GenerateExamplesFn(beam.DoFn):
       self._bad_example_count.inc()
       return None
 
+    if self._use_before_image:
+      before_png = _encode_png(before_crop)
+      before_large_bytes = self._encode_large_patch(before_image)
+    else:
+      before_png = self._blank_before_png
+      before_large_bytes = self._blank_before_large_bytes
+
     example = Example()
     # TODO(jzxu): Use constants for these feature name strings.
 
@@ -449,18 +781,10 @@ class GenerateExamplesFn(beam.DoFn):
     utils.add_bytes_feature('plus_code', plus_code.encode(), example)
     utils.add_bytes_feature('example_id', example_id.encode(), example)
     utils.add_int64_feature('int64_id', int64_id, example)
-    utils.add_bytes_feature(
-        'pre_image_png_large', tf.io.encode_png(before_image).numpy(), example
-    )
-    utils.add_bytes_feature(
-        'pre_image_png', tf.io.encode_png(before_crop).numpy(), example
-    )
+    utils.add_bytes_feature('pre_image_png', before_png, example)
     utils.add_bytes_feature('pre_image_id', before_image_id.encode(), example)
     utils.add_bytes_feature(
-        'post_image_png_large', tf.io.encode_png(after_image).numpy(), example
-    )
-    utils.add_bytes_feature(
-        'post_image_png', tf.io.encode_png(after_crop).numpy(), example
+        'post_image_png', _encode_png(after_crop), example
     )
     utils.add_bytes_feature('post_image_id', after_image_id.encode(), example)
 
@@ -479,32 +803,35 @@ class GenerateExamplesFn(beam.DoFn):
         utils.add_bytes_list_feature(name, [v.encode() for v in value], example)
       else:
         utils.add_float_list_feature(name, value, example)
-    return example
+
+    large_example = Example()
+    large_example.CopyFrom(example)
+    utils.add_bytes_feature(
+        'pre_image_png_large', before_large_bytes, large_example
+    )
+    utils.add_bytes_feature(
+        'post_image_png_large',
+        self._encode_large_patch(after_image),
+        large_example,
+    )
+    return example, large_example
 
   def process(
-      self, grouped_features: Tuple[str, Iterable[_FeatureUnion]]
+      self, grouped_features: Tuple[str, _GroupedFeatures]
   ) -> Iterator[Example]:
     """Extract patches from before and after images and output as tf Example.
 
     Args:
-      grouped_features: Tuple of example id, list of features for that example.
-        The elements of the features list are FeatureUnions that can be either
-        scalar features or images.
+      grouped_features: Tuple of example id, all features for that example.
 
     Yields:
-      Serialized Tensorflow Example.
+      Tensorflow Examples with small image patches to the main output, and
+      Examples that also include large image patches to the "large" output.
     """
     example_id, features = grouped_features
-    before_images = []
-    after_images = []
-    scalar_features = {}
-    for feature in features:
-      if feature.scalar_features:
-        scalar_features.update(feature.scalar_features)
-      elif feature.before_image:
-        before_images.append(feature.before_image)
-      elif feature.after_image:
-        after_images.append(feature.after_image)
+    before_images = features.before_images
+    after_images = features.after_images
+    scalar_features = features.scalar_features
 
     if not after_images:
       self._after_patch_blank_count.inc()
@@ -517,18 +844,45 @@ class GenerateExamplesFn(beam.DoFn):
         self._bad_example_count.inc()
         return
     else:
-      before_image = np.zeros(
-          (self._large_patch_size, self._large_patch_size, 3), dtype=np.uint8)
-      before_images = [('', before_image)]
+      before_images = [('', self._blank_before_image)]
+
+    # Each image takes part in several alignments, so only convert it to
+    # grayscale once.
+    if self._use_before_image:
+      before_grays = [_to_grayscale(image) for _, image in before_images]
+      after_grays = [_to_grayscale(image) for _, image in after_images]
 
+    # Tuples of (alignment score, before image index, aligned after image,
+    # after image index).
+    pairs = []
     for i, j in itertools.product(range(len(before_images)),
                                   range(len(after_images))):
-      example = self._create_example(example_id, before_images[i][0],
-                                     before_images[i][1], after_images[j][0],
-                                     after_images[j][1], scalar_features)
-      if example:
+      if self._use_before_image:
+        aligned_after, score = align_after_image(
+            before_images[i][1], after_images[j][1], before_grays[i],
+            after_grays[j])
+      else:
+        aligned_after, score = after_images[j][1], 0.0
+      pairs.append((score, i, aligned_after, j))
+
+    if self._max_pairs_per_location:
+      # The sort is stable, so pairs with equal scores keep their order.
+      pairs.sort(key=lambda pair: pair[0], reverse=True)
+
+    num_examples = 0
+    for _, i, aligned_after, j in pairs:
+      if (self._max_pairs_per_location and
+          num_examples >= self._max_pairs_per_location):
+        break
+      examples = self._create_example(example_id, before_images[i][0],
+                                      before_images[i][1], after_images[j][0],
+                                      aligned_after, scalar_features)
+      if examples:
+        small_example, large_example = examples
+        num_examples += 1
         self._example_count.inc()
-        yield example
+        yield small_example
+        yield beam.pvalue.TaggedOutput('large', large_example)
 
 
 def _coordinates_to_scalar_features(coordinates_path: str):
@@ -543,14 +897,6 @@ def _coordinates_to_scalar_features(coordinates_path: str):
     yield (encoded_coords, feature)
 
 
-def _remove_large_images(example: Example) -> Example:
-  new_example = Example()
-  new_example.CopyFrom(example)
-  del new_example.features.feature['pre_image_png_large']
-  del new_example.features.feature['post_image_png_large']
-  return new_example
-
-
 def _expand_patterns(patterns: Iterable[str]) -> List[str]:
   """Returns the list of paths matched by a list of URI patterns.
 
@@ -583,6 +929,8 @@ def _generate_examples(
     gdal_env: Dict[str, str],
     stage_prefix: str,
     cloud_detector_model_path: Optional[str] = None,
+    max_pairs_per_location: Optional[int] = None,
+    large_patch_jpeg_quality: Optional[int] = None,
 ) -> Tuple[beam.PCollection, beam.PCollection]:
   """Generates examples and labeling images from source images.
 
@@ -598,6 +946,10 @@ def _generate_examples(
     gdal_env: GDAL environment configuration.
     stage_prefix: Beam stage name prefix.
     cloud_detector_model_path: Path to tflite cloud detector model.
+    max_pairs_per_location: Maximum number of (before, after) image pairs to
+      generate examples for at each location. If None, uses all pairs.
+    large_patch_jpeg_quality: If set, JPEG quality to encode large image
+      patches with. If None, large patches are PNG encoded.
 
   Returns:
     PCollection of examples and PCollection of labeling images.
@@ -607,7 +959,8 @@ def _generate_examples(
       | stage_prefix + 'encode_coordinates_path' >> beam.Create(
           [coordinates_path])
       | stage_prefix + 'create_scalar_features' >> beam.FlatMap(
-          _coordinates_to_scalar_features))
+          _coordinates_to_scalar_features
+      ).with_output_types(Tuple[str, _FeatureUnion]))
 
   input_collections = [scalar_features]
   after_image_size = large_patch_size
@@ -631,7 +984,8 @@ def _generate_examples(
     before_image_features = (
         before_patches
         | stage_prefix + '_before_to_feature' >> beam.MapTuple(
-            lambda key, value: (key, _FeatureUnion(before_image=value))))
+            lambda key, value: (key, _FeatureUnion(before_image=value))
+        ).with_output_types(Tuple[str, _FeatureUnion]))
     input_collections.append(before_image_features)
 
   after_raster_paths = _expand_patterns(after_image_patterns)
@@ -647,13 +1001,15 @@ def _generate_examples(
   after_image_features = (
       after_patches
       | stage_prefix + '_after_to_feature' >> beam.MapTuple(
-          lambda key, value: (key, _FeatureUnion(after_image=value))))
+          lambda key, value: (key, _FeatureUnion(after_image=value))
+      ).with_output_types(Tuple[str, _FeatureUnion]))
   input_collections.append(after_image_features)
 
-  large_examples = (
+  examples = (
       input_collections
       | stage_prefix + '_merge_features' >> beam.Flatten()
-      | stage_prefix + '_group_by_example_id' >> beam.GroupByKey()
+      | stage_prefix + '_combine_by_example_id'
+      >> beam.CombinePerKey(_FeatureUnionCombineFn())
       | stage_prefix + '_generate_examples'
       >> beam.ParDo(
           GenerateExamplesFn(
@@ -661,16 +1017,13 @@ def _generate_examples(
               example_patch_size,
               use_before_image,
               cloud_detector_model_path,
+              max_pairs_per_location,
+              large_patch_jpeg_quality,
           )
-      )
+      ).with_outputs('large', main='small')
   )
 
-  small_examples = (
-      large_examples
-      | stage_prefix + '_generate_small_example' >> beam.Map(
-          _remove_large_images))
-
-  return large_examples, small_examples
+  return examples.large, examples.small
 
 
 def read_labels_file(
@@ -700,8 +1053,8 @@ def read_labels_file(
     List of tuples of the form (longitude, latitude, float label).
   """
   # Parse labels_to_classes into dictionary format if specified
+  label_to_class_dict = {}
   if labels_to_classes:
-    label_to_class_dict = {}
     for label_to_class in labels_to_classes:
       if '=' not in label_to_class:
         raise ValueError(
@@ -716,24 +1069,50 @@ def read_labels_file(
 
   # Generate coordinates from label file
   df = gpd.read_file(path).to_crs(epsg=4326)
-  coordinates = []
-  for _, row in df.iterrows():
-    centroid = row.geometry.centroid
-    label = row[label_property]
-    if isinstance(label, str):
-      try:
-        float_label = label_to_class_dict[label]
-        coordinates.append((centroid.x, centroid.y, float_label, label))
-      except KeyError:
-        logging.warning('Label %s is not recognized.', label)
-    elif isinstance(label, (int, float)):
-      float_label = float(label)
-      coordinates.append((centroid.x, centroid.y, float_label, str(label)))
-    else:
-      raise ValueError(f'Unrecognized label property type {type(label)}')
+  labels = df[label_property]
+  if labels.dtype.kind in 'biuf':
+    is_string = np.zeros(len(labels), dtype=bool)
+  else:
+    is_string = labels.map(lambda v: isinstance(v, str)).to_numpy(dtype=bool)
+    is_number = labels.map(lambda v: isinstance(v, (int, float))).to_numpy(
+        dtype=bool
+    )
+    invalid = ~(is_string | is_number)
+    if invalid.any():
+      raise ValueError(
+          'Unrecognized label property type'
+          f' {type(labels.iloc[np.argmax(invalid)])}'
+      )
+
+  float_labels = np.empty(len(labels), dtype=np.float64)
+  float_labels[~is_string] = labels[~is_string].to_numpy(dtype=np.float64)
+  float_labels[is_string] = (
+      labels[is_string].map(label_to_class_dict).to_numpy(dtype=np.float64)
+  )
+  recognized = np.zeros(len(labels), dtype=bool)
+  recognized[is_string] = labels[is_string].isin(list(label_to_class_dict))
+  for label in labels[is_string & ~recognized]:
+    logging.warning('Label %s is not recognized.', label)
 
+  # Only compute centroids for the rows that are kept.
+  keep = np.flatnonzero(~is_string | recognized)
   if max_points:
-    coordinates = coordinates[:max_points]
+    keep = keep[:max_points]
+  df = df.iloc[keep]
+  with warnings.catch_warnings():
+    # Centroids have always been computed in EPSG:4326 coordinates.
+    warnings.filterwarnings(
+        'ignore', 'Geometry is in a geographic CRS', UserWarning
+    )
+    centroids = df.geometry.centroid
+  coordinates = list(
+      zip(
+          centroids.x.tolist(),
+          centroids.y.tolist(),
+          float_labels[keep].tolist(),
+          df[label_property].astype(str).tolist(),
+      )
+  )
 
   # logging.info('Read %d labeled coordinates.', len(coordinates))
   return coordinates
@@ -776,7 +1155,9 @@ def generate_examples_pipeline(
     cloud_region: Optional[str],
     worker_service_account: Optional[str],
     max_workers: int,
-    cloud_detector_model_path: Optional[str] = None) -> None:
+    cloud_detector_model_path: Optional[str] = None,
+    max_pairs_per_location: Optional[int] = None,
+    large_patch_jpeg_quality: Optional[int] = None) -> None:
   """Runs example generation pipeline.
 
   Args:
@@ -800,6 +1181,11 @@ def generate_examples_pipeline(
     worker_service_account: Email of service account that will launch workers.
     max_workers: Maximum number of workers to use.
     cloud_detector_model_path: Path to tflite cloud detector model.
+    max_pairs_per_location: Maximum number of (before, after) image pairs to
+      generate examples for at each location. Pairs with the best alignment
+      scores are used first. If None, uses all pairs.
+    large_patch_jpeg_quality: If set, JPEG quality to encode large image
+      patches with, e.g. 90. If None, large patches are PNG encoded.
   """
 
   temp_dir = os.path.join(output_dir, 'temp')
@@ -835,12 +1221,17 @@ def generate_examples_pipeline(
     large_examples, small_examples = _generate_examples(
         pipeline, before_image_patterns, after_image_patterns, coordinates_path,
         large_patch_size, example_patch_size, resolution, gdal_env,
-        'generate_examples', cloud_detector_model_path)
+        'generate_examples', cloud_detector_model_path,
+        max_pairs_per_location, large_patch_jpeg_quality)
 
+    # Examples are serialized before reshuffling so that only the encoded
+    # bytes are shuffled, and the reshuffle spreads writing over all workers
+    # instead of fusing it with example generation.
     _ = (
         small_examples
         | 'serialize_small_examples' >> beam.Map(
             lambda e: e.SerializeToString())
+        | 'reshuffle_small_examples' >> beam.Reshuffle()
         | 'write_small_examples' >> beam.io.tfrecordio.WriteToTFRecord(
             small_examples_output_prefix,
             file_name_suffix='.tfrecord',
@@ -849,6 +1240,7 @@ def generate_examples_pipeline(
         large_examples
         | 'serialize_large_examples' >> beam.Map(
             lambda e: e.SerializeToString())
+        | 'reshuffle_large_examples' >> beam.Reshuffle()
         | 'write_large_examples' >> beam.io.tfrecordio.WriteToTFRecord(
             large_examples_output_prefix,
             file_name_suffix='.tfrecord',
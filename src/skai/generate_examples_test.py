@@ -26,7 +26,9 @@ import apache_beam as beam
 from apache_beam.testing import test_pipeline
 from apache_beam.testing.util import assert_that
 from apache_beam.testing.util import equal_to
+import geopandas as gpd
 import numpy as np
+import shapely.geometry
 from skai import generate_examples
 from skai import utils
 import tensorflow as tf
@@ -192,7 +194,9 @@ class GenerateExamplesTest(parameterized.TestCase):
     super().setUp()
     current_dir = pathlib.Path(__file__).parent
     self.test_image_path = str(current_dir / TEST_IMAGE_PATH)
-    self.coordinates_path = str(current_dir / 'coordinates')
+    self.coordinates_path = os.path.join(
+        tempfile.mkdtemp(dir=absltest.TEST_TMPDIR.value), 'coordinates'
+    )
     self.test_image_path_patterns = str(current_dir / 'test_data/country_*.tif')
     self.test_config_path = str(current_dir / TEST_CONFIG_PATH)
     self.test_missing_dataset_name_config_path = str(
@@ -366,6 +370,115 @@ class GenerateExamplesTest(parameterized.TestCase):
                   equal_to(expected_before_image_ids),
                   'check large examples before image ids')
 
+  def testGenerateExampleFnMaxPairsPerLocation(self):
+    """Tests that only the best aligned image pairs are used."""
+    coordinates = [(178.482925, -16.632893, -1.0, '')]
+    utils.write_coordinates_file(coordinates, self.coordinates_path)
+
+    expected_before_image_ids = glob.glob(self.test_image_path_patterns)
+
+    with test_pipeline.TestPipeline() as pipeline:
+      # The path patterns specify two before images.
+      _, small_examples = generate_examples._generate_examples(
+          pipeline, [self.test_image_path_patterns],
+          [self.test_image_path], self.coordinates_path, 62, 32, 0.5,
+          {}, 'unlabeled', max_pairs_per_location=1)
+
+      def _check_before_ids(before_ids):
+        assert len(before_ids) == 1, before_ids
+        assert before_ids[0] in expected_before_image_ids, before_ids
+
+      assert_that(
+          small_examples | beam.Map(_get_before_image_id), _check_before_ids
+      )
+
+  def testAlignAfterImageSearchesOnlyAroundCenter(self):
+    rng = np.random.default_rng(0)
+    # The after image is larger than rows + 2 * _MAX_DISPLACEMENT, so only a
+    # region around its center is searched.
+    after_image = rng.integers(0, 256, (200, 200, 3), dtype=np.uint8)
+    before_image = after_image[84 + 12:116 + 12, 84 - 20:116 - 20].copy()
+    # An identical copy outside of the search region must not be matched.
+    after_image[:32, :32] = before_image
+
+    aligned_after_image, score = generate_examples.align_after_image(
+        before_image, after_image
+    )
+    np.testing.assert_array_equal(
+        aligned_after_image, after_image[96:128, 64:96]
+    )
+    self.assertAlmostEqual(score, 1.0, places=4)
+
+  def testGenerateExampleFnMaxPairsPerLocationPicksBestAlignedPair(self):
+    rng = np.random.default_rng(0)
+    after_image = rng.integers(1, 256, (124, 124, 3), dtype=np.uint8)
+    # The "good" before image is an exact crop of the after image, so it aligns
+    # perfectly. The "bad" one is unrelated noise. The bad pair comes first, so
+    # it would be picked if pairs were not ranked by alignment score.
+    good_before_image = after_image[25:89, 33:97].copy()
+    bad_before_image = rng.integers(1, 256, (64, 64, 3), dtype=np.uint8)
+
+    _, good_score = generate_examples.align_after_image(
+        good_before_image, after_image
+    )
+    _, bad_score = generate_examples.align_after_image(
+        bad_before_image, after_image
+    )
+    self.assertAlmostEqual(good_score, 1.0, places=4)
+    self.assertLess(bad_score, 0.5)
+
+    generate_fn = generate_examples.GenerateExamplesFn(
+        64, 32, True, max_pairs_per_location=1
+    )
+    generate_fn.setup()
+    features = generate_examples._GroupedFeatures(
+        scalar_features={'coordinates': [178.5, -16.6]},
+        before_images=[('bad', bad_before_image), ('good', good_before_image)],
+        after_images=[('after', after_image)],
+    )
+    outputs = list(generate_fn.process(('encoded_coordinates', features)))
+    small_examples = [
+        output for output in outputs
+        if not isinstance(output, beam.pvalue.TaggedOutput)
+    ]
+    self.assertLen(small_examples, 1)
+    self.assertEqual(_get_before_image_id(small_examples[0]), 'good')
+    # The after image crop must be the one aligned to the good before image.
+    np.testing.assert_array_equal(
+        _deserialize_image(
+            small_examples[0].features.feature['pre_image_png']
+            .bytes_list.value[0]
+        ),
+        _deserialize_image(
+            small_examples[0].features.feature['post_image_png']
+            .bytes_list.value[0]
+        ),
+    )
+
+  def testGenerateExampleFnLargePatchJpeg(self):
+    coordinates = [(178.482925, -16.632893, -1.0, '')]
+    utils.write_coordinates_file(coordinates, self.coordinates_path)
+
+    with test_pipeline.TestPipeline() as pipeline:
+      large_examples, _ = generate_examples._generate_examples(
+          pipeline, [self.test_image_path], [self.test_image_path],
+          self.coordinates_path, 62, 32, 0.5, {}, 'unlabeled',
+          large_patch_jpeg_quality=90)
+
+      def _check_large_patches(examples):
+        assert len(examples) == 1, examples
+        for feature in ['pre_image_png_large', 'post_image_png_large']:
+          image_bytes = examples[0].features.feature[feature].bytes_list.value[0]
+          assert image_bytes.startswith(b'\xff\xd8'), 'Not a JPEG image.'
+          image = tf.io.decode_jpeg(image_bytes).numpy()
+          assert image.shape == (62, 62, 3), image.shape
+        small_image_bytes = (
+            examples[0].features.feature['pre_image_png'].bytes_list.value[0]
+        )
+        assert small_image_bytes.startswith(b'\x89PNG'), 'Not a PNG image.'
+
+      assert_that(large_examples, _check_large_patches)
+
   def testGenerateExamplesPipeline(self):
     output_dir = tempfile.mkdtemp(dir=absltest.TEST_TMPDIR.value)
     coordinates = [(178.482925, -16.632893), (178.482283, -16.632279)]
@@ -390,6 +503,94 @@ class GenerateExamplesTest(parameterized.TestCase):
     tfrecords = os.listdir(os.path.join(output_dir, 'examples', 'unlabeled'))
     self.assertSameElements(tfrecords, ['unlabeled-00000-of-00001.tfrecord'])
 
+  def testMostlyBlank(self):
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    self.assertTrue(generate_examples._mostly_blank(image))
+    # A single non-blank row leaves most pixels blank.
+    image[0, :, 0] = 255
+    self.assertTrue(generate_examples._mostly_blank(image))
+    image[:7, :, 1] = 255
+    self.assertFalse(generate_examples._mostly_blank(image))
+
+  def testEncodePngRoundTrip(self):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(16, 12, 3), dtype=np.uint8)
+    decoded = _deserialize_image(generate_examples._encode_png(image))
+    np.testing.assert_array_equal(decoded, image)
+
+  def testReadLabelsFile(self):
+    labels_path = os.path.join(
+        tempfile.mkdtemp(dir=absltest.TEST_TMPDIR.value), 'labels.geojson'
+    )
+    gpd.GeoDataFrame(
+        {
+            'string_label': ['damaged', 'unknown', 'no_damage', 'damaged'],
+            'float_label': [1.0, 0.0, 0.5, 1.0],
+        },
+        geometry=[
+            shapely.geometry.Point(1, 2),
+            shapely.geometry.Point(3, 4),
+            shapely.geometry.Polygon([(5, 6), (7, 6), (7, 8), (5, 8)]),
+            shapely.geometry.Point(9, 10),
+        ],
+        crs='EPSG:4326',
+    ).to_file(labels_path)
+
+    self.assertEqual(
+        generate_examples.read_labels_file(
+            labels_path,
+            'string_label',
+            ['damaged=1', 'no_damage=0'],
+            max_points=2,
+        ),
+        [(1.0, 2.0, 1.0, 'damaged'), (6.0, 7.0, 0.0, 'no_damage')],
+    )
+    self.assertEqual(
+        generate_examples.read_labels_file(labels_path, 'float_label'),
+        [
+            (1.0, 2.0, 1.0, '1.0'),
+            (3.0, 4.0, 0.0, '0.0'),
+            (6.0, 7.0, 0.5, '0.5'),
+            (9.0, 10.0, 1.0, '1.0'),
+        ],
+    )
+
+  def testEncodeJpeg(self):
+    # A smooth gray gradient survives lossy compression nearly unchanged.
+    image = np.broadcast_to(
+        np.linspace(0, 255, 32, dtype=np.uint8)[None, :, None], (32, 32, 3)
+    )
+    decoded = _deserialize_image(generate_examples._encode_jpeg(image, 90))
+    self.assertEqual(decoded.shape, image.shape)
+    np.testing.assert_allclose(decoded, image, atol=8)
+
+  def testGroupedFeaturesCoderRoundTrip(self):
+    rng = np.random.default_rng(0)
+    features = generate_examples._GroupedFeatures(
+        scalar_features={'coordinates': [178.5, -16.6], 'string_label': ['a']},
+        before_images=[
+            ('before.tif', rng.integers(0, 256, (8, 6, 3), dtype=np.uint8))
+        ],
+        after_images=[
+            ('after1.tif', rng.integers(0, 256, (10, 12, 3), dtype=np.uint8)),
+            ('after2.tif', rng.random((4, 4), dtype=np.float32)),
+        ],
+    )
+    coder = generate_examples._GroupedFeaturesCoder()
+    decoded = coder.decode(coder.encode(features))
+    self.assertEqual(decoded.scalar_features, features.scalar_features)
+    for expected_images, actual_images in [
+        (features.before_images, decoded.before_images),
+        (features.after_images, decoded.after_images),
+    ]:
+      self.assertLen(actual_images, len(expected_images))
+      for (expected_path, expected), (actual_path, actual) in zip(
+          expected_images, actual_images
+      ):
+        self.assertEqual(actual_path, expected_path)
+        self.assertEqual(actual.dtype, expected.dtype)
+        np.testing.assert_array_equal(actual, expected)
+
   def testConfigLoadedCorrectlyFromJsonFile(self):
     config = generate_examples.ExamplesGenerationConfig.init_from_json_path(
         self.test_config_path
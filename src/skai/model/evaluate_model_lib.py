@@ -1,45 +1,101 @@
 r"""Library for evaluating active sampling.
 """
 
+import ast
 import os
 from typing import Mapping
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
 from skai.model import data
 import tensorflow as tf
 
 
+def _read_subgroup_labels(
+    ds: tf.data.Dataset,
+    batch_size: int,
+) -> pd.DataFrame:
+  """Reads example ids, subgroup labels and labels from ds into a table."""
+  ids = []
+  subgroup_labels = []
+  labels = []
+  # Read all needed features in a single pass over the dataset.
+  batches = (
+      ds.map(
+          lambda example: (
+              example['example_id'],
+              example['subgroup_label'],
+              example['label'],
+          ),
+          num_parallel_calls=tf.data.AUTOTUNE,
+      )
+      .batch(batch_size)
+      .prefetch(tf.data.AUTOTUNE)
+  )
+  for batch_ids, batch_subgroup_labels, batch_labels in (
+      batches.as_numpy_iterator()):
+    ids.append(batch_ids)
+    subgroup_labels.append(batch_subgroup_labels)
+    labels.append(batch_labels)
+  ids = np.char.decode(np.concatenate(ids).astype(np.bytes_), 'UTF-8')
+  subgroup_labels = np.concatenate(subgroup_labels).tolist()
+  labels = np.concatenate(labels).tolist()
+  return pd.DataFrame({
+      'example_id': ids, 'subgroup_label': subgroup_labels,
+      'label': labels})
+
+
+def _merge_labels_table(
+    table: pd.DataFrame,
+    labels_table: pd.DataFrame,
+) -> pd.DataFrame:
+  """Merge table with labels previously read by _read_subgroup_labels."""
+  # The inner join also drops rows of table whose ids are not in labels_table.
+  return pd.merge(table, labels_table, on=['example_id'])
+
+
 def merge_subgroup_labels(
     ds: tf.data.Dataset,
     table: pd.DataFrame,
     batch_size: int,
 ):
   """Merge table with subroup labels from ds."""
-  ids = np.concatenate(list(
-      ds.map(lambda example: example['example_id']).batch(
-          batch_size).as_numpy_iterator())).tolist()
-  ids = list(map(lambda x: x.decode('UTF-8'), ids))
-  subgroup_labels = np.concatenate(list(
-      ds.map(lambda example: example['subgroup_label']).batch(
-          batch_size).as_numpy_iterator())).tolist()
-  labels = np.concatenate(list(
-      ds.map(lambda example: example['label']).batch(
-          batch_size).as_numpy_iterator())).tolist()
-  df_a = pd.DataFrame({
-      'example_id': ids, 'subgroup_label': subgroup_labels,
-      'label': labels})
-  table = table[table['example_id'].isin(ids)]
-  return pd.merge(table, df_a, on=['example_id'])
+  return _merge_labels_table(table, _read_subgroup_labels(ds, batch_size))
+
+
+def _read_csv(path: str) -> pd.DataFrame:
+  """Reads a bias or predictions table with pyarrow's multithreaded parser."""
+  with tf.io.gfile.GFile(path, 'rb') as f:
+    contents = f.read()
+  table = pa_csv.read_csv(
+      pa.BufferReader(contents),
+      convert_options=pa_csv.ConvertOptions(
+          column_types={'example_id': pa.string()}))
+  return table.to_pandas()
+
+
+def _decode_bytes_literals(values: pd.Series) -> pd.Series:
+  """Decodes strings holding Python bytes literals, e.g. "b'abc'" -> 'abc'."""
+  # Literals without quotes or escape sequences can be decoded by stripping the
+  # enclosing b'...'. Only the remaining ones need to be parsed.
+  is_simple = values.str.match(r"^b'[^'\\]*'$")
+  decoded = values.str.slice(2, -1)
+  if not is_simple.all():
+    decoded[~is_simple] = values[~is_simple].map(
+        lambda x: ast.literal_eval(x).decode('UTF-8'))
+  return decoded
 
 
 def _process_table(table: pd.DataFrame, prediction: bool):
   """Modify table to have cleaned up example ids and predictions."""
-  table['example_id'] = table['example_id'].map(
-      lambda x: eval(x).decode('UTF-8'))  #  pylint:disable=eval-used
+  table['example_id'] = _decode_bytes_literals(table['example_id'])
   if prediction:
-    prediction_label_cols = filter(lambda x: 'label' in x, table.columns)
-    prediction_bias_cols = filter(lambda x: 'bias' in x, table.columns)
+    prediction_label_cols = table.columns[
+        table.columns.str.contains('label', regex=False)]
+    prediction_bias_cols = table.columns[
+        table.columns.str.contains('bias', regex=False)]
     table['bias'] = table[prediction_bias_cols].mean(axis=1)
     table['label_prediction'] = table[prediction_label_cols].mean(axis=1)
   return table
@@ -53,23 +109,25 @@ def evaluate_active_sampling(
     num_subgroups: int,
     ) -> pd.DataFrame:
   """Evaluates model for subgroup representation vs number of rounds."""
-  round_idx = []
-  subgroup_ids = []
-  num_samples = []
-  prob_representation = []
+  # One row per (round, subgroup) pair, in round-major order.
+  round_idx = np.repeat(np.arange(num_rounds), num_subgroups)
+  subgroup_ids = np.tile(np.arange(num_subgroups), num_rounds)
+  num_samples = np.empty(num_rounds * num_subgroups, dtype=np.int64)
+  prob_representation = np.empty(num_rounds * num_subgroups, dtype=np.float64)
+  # The training set is the same in every round, so only read it once.
+  train_labels = _read_subgroup_labels(dataloader.train_ds, batch_size)
   for idx in range(num_rounds):
-    ds = dataloader.train_ds
-    bias_table = pd.read_csv(
+    bias_table = _read_csv(
         os.path.join(
             os.path.join(output_dir, f'round_{idx}'), 'bias_table.csv'))
-    predictions_merge = merge_subgroup_labels(ds, bias_table, batch_size)
-    for subgroup_id in range(num_subgroups):
-      prob_i = (predictions_merge['subgroup_label']
-                == subgroup_id).sum() / len(predictions_merge)
-      round_idx.append(idx)
-      subgroup_ids.append(subgroup_id)
-      num_samples.append(len(predictions_merge))
-      prob_representation.append(prob_i)
+    predictions_merge = _merge_labels_table(bias_table, train_labels)
+    subgroup_labels = predictions_merge['subgroup_label'].to_numpy()
+    subgroup_labels = subgroup_labels[
+        (subgroup_labels >= 0) & (subgroup_labels < num_subgroups)]
+    subgroup_counts = np.bincount(subgroup_labels, minlength=num_subgroups)
+    rows = slice(idx * num_subgroups, (idx + 1) * num_subgroups)
+    num_samples[rows] = len(predictions_merge)
+    prob_representation[rows] = subgroup_counts / len(predictions_merge)
   return pd.DataFrame({
       'num_samples': num_samples,
       'prob_representation': prob_representation,
@@ -85,27 +143,30 @@ def evaluate_model(
     batch_size: int,
     ) -> Mapping[str, pd.DataFrame]:
   """Evaluates model for subgroup representation vs number of rounds."""
-  bias_table = pd.read_csv(
+  bias_table = _read_csv(
       os.path.join(
           os.path.join(output_dir, f'round_{round_idx}'), 'bias_table.csv'))
   bias_table = _process_table(bias_table, False)
-  predictions_table = pd.read_csv(
+  predictions_table = _read_csv(
       os.path.join(
           os.path.join(output_dir, f'round_{round_idx}'),
           'predictions_table.csv'))
   predictions_table = _process_table(predictions_table, True)
   predictions_merge = {}
-  predictions_merge['train_bias'] = merge_subgroup_labels(
-      dataloader.train_ds, bias_table, batch_size)
-  predictions_merge['train_predictions'] = merge_subgroup_labels(
-      dataloader.train_ds, predictions_table, batch_size)
+  # Each dataset is merged with two tables, so read its labels only once.
+  train_labels = _read_subgroup_labels(dataloader.train_ds, batch_size)
+  predictions_merge['train_bias'] = _merge_labels_table(
+      bias_table, train_labels)
+  predictions_merge['train_predictions'] = _merge_labels_table(
+      predictions_table, train_labels)
   for (ds_name, ds) in dataloader.eval_ds.items():
-    predictions_table = _process_table(pd.read_csv(
+    eval_labels = _read_subgroup_labels(ds, batch_size)
+    predictions_table = _process_table(_read_csv(
         os.path.join(
             os.path.join(output_dir, f'round_{round_idx}'),
             f'predictions_table_{ds_name}.csv')), True)
-    predictions_merge[f'{ds_name}_predictions'] = merge_subgroup_labels(
-        ds, predictions_table, batch_size)
-    predictions_merge[f'{ds_name}_bias'] = merge_subgroup_labels(
-        ds, bias_table, batch_size)
+    predictions_merge[f'{ds_name}_predictions'] = _merge_labels_table(
+        predictions_table, eval_labels)
+    predictions_merge[f'{ds_name}_bias'] = _merge_labels_table(
+        bias_table, eval_labels)
   return predictions_merge
@@ -0,0 +1,260 @@
+"""Tests for evaluate_model_lib."""
+
+import os
+import tempfile
+from unittest import mock
+
+from absl.testing import absltest
+import pandas as pd
+from skai.model import data
+from skai.model import evaluate_model_lib
+import tensorflow as tf
+
+
+def _make_temp_dir() -> str:
+  return tempfile.mkdtemp(dir=absltest.TEST_TMPDIR.value)
+
+
+def _make_dataset(
+    example_ids: list[bytes], subgroup_labels: list[int], labels: list[int]
+) -> tf.data.Dataset:
+  return tf.data.Dataset.from_tensor_slices({
+      'example_id': tf.constant(example_ids, dtype=tf.string),
+      'subgroup_label': tf.constant(subgroup_labels, dtype=tf.int64),
+      'label': tf.constant(labels, dtype=tf.int64),
+  })
+
+
+def _make_dataloader() -> data.Dataloader:
+  # Subgroup labels -1 and 5 are outside of the 3 subgroups.
+  train_ds = _make_dataset(
+      [b'a', b'b', b'c', b'd', b'e', b'f'],
+      [0, 1, 1, 2, -1, 5],
+      [0, 1, 0, 1, 1, 0],
+  )
+  return data.Dataloader(
+      num_subgroups=3,
+      subgroup_sizes={},
+      train_splits=train_ds,
+      val_splits=train_ds,
+      train_ds=train_ds,
+      eval_ds={'val': _make_dataset([b'c', b'g'], [1, 0], [0, 1])},
+  )
+
+
+def _write_round_table(
+    output_dir: str, round_idx: int, name: str, table: pd.DataFrame
+) -> None:
+  round_dir = os.path.join(output_dir, f'round_{round_idx}')
+  os.makedirs(round_dir, exist_ok=True)
+  table.to_csv(os.path.join(round_dir, name), index=False)
+
+
+class EvaluateModelLibTest(absltest.TestCase):
+
+  def test_decode_bytes_literals(self):
+    ids = ['a', "it's", 'back\\slash', 'café', '建物', '']
+    values = pd.Series([repr(x.encode('UTF-8')) for x in ids])
+    self.assertEqual(
+        evaluate_model_lib._decode_bytes_literals(values).tolist(), ids
+    )
+
+  def test_decode_bytes_literals_matches_eval(self):
+    values = pd.Series(
+        ["b'abc'", 'b"it\'s"', "b'\\xc3\\xa9'", "b'a\\\\b'", "b'\\''"]
+    )
+    expected = [eval(x).decode('UTF-8') for x in values]  # pylint: disable=eval-used
+    self.assertEqual(
+        evaluate_model_lib._decode_bytes_literals(values).tolist(), expected
+    )
+
+  def test_decode_bytes_literals_empty(self):
+    decoded = evaluate_model_lib._decode_bytes_literals(
+        pd.Series([], dtype=object)
+    )
+    self.assertEmpty(decoded)
+
+  def test_process_table(self):
+    table = pd.DataFrame({
+        'example_id': ["b'a'", "b'b'"],
+        'label_0': [0.2, 0.4],
+        'label_1': [0.4, 0.8],
+        'bias_0': [0.1, 0.3],
+    })
+    table = evaluate_model_lib._process_table(table, prediction=True)
+    self.assertEqual(table['example_id'].tolist(), ['a', 'b'])
+    self.assertSequenceAlmostEqual(
+        table['label_prediction'].tolist(), [0.3, 0.6]
+    )
+    self.assertSequenceAlmostEqual(table['bias'].tolist(), [0.1, 0.3])
+
+  def test_read_csv(self):
+    path = os.path.join(_make_temp_dir(), 'bias_table.csv')
+    table = pd.DataFrame({
+        'example_id': ['0123', "b'it\\'s'", 'café'],
+        'bias': [0.5, 1.0, 0.0],
+    })
+    table.to_csv(path, index=False)
+    actual = evaluate_model_lib._read_csv(path)
+    # Ids that look like numbers must stay strings.
+    pd.testing.assert_frame_equal(actual, table)
+
+  def test_read_csv_empty_table(self):
+    path = os.path.join(_make_temp_dir(), 'bias_table.csv')
+    with open(path, 'w') as f:
+      f.write('example_id,bias\n')
+    actual = evaluate_model_lib._read_csv(path)
+    self.assertEmpty(actual)
+    self.assertEqual(actual.columns.tolist(), ['example_id', 'bias'])
+
+  def test_read_subgroup_labels(self):
+    ds = _make_dataset(
+        ['a'.encode(), 'café'.encode(), b'c'], [0, 1, 2], [1, 0, 1]
+    )
+    # A batch size that does not divide the dataset size.
+    labels_table = evaluate_model_lib._read_subgroup_labels(ds, batch_size=2)
+    self.assertEqual(
+        labels_table.to_dict('list'),
+        {
+            'example_id': ['a', 'café', 'c'],
+            'subgroup_label': [0, 1, 2],
+            'label': [1, 0, 1],
+        },
+    )
+
+  def test_merge_subgroup_labels(self):
+    ds = _make_dataset([b'a', b'b', b'c'], [0, 1, 0], [1, 0, 1])
+    table = pd.DataFrame({
+        'example_id': ['c', 'unmatched', 'a'],
+        'bias': [0.3, 0.9, 0.1],
+    })
+    merged = evaluate_model_lib.merge_subgroup_labels(ds, table, batch_size=2)
+    # Rows without labels in ds are dropped, and the order of table is kept.
+    self.assertEqual(
+        merged.to_dict('list'),
+        {
+            'example_id': ['c', 'a'],
+            'bias': [0.3, 0.1],
+            'subgroup_label': [0, 0],
+            'label': [1, 1],
+        },
+    )
+
+  def test_merge_subgroup_labels_empty_table(self):
+    ds = _make_dataset([b'a', b'b'], [0, 1], [1, 0])
+    table = pd.DataFrame({
+        'example_id': pd.Series([], dtype=object),
+        'bias': pd.Series([], dtype=float),
+    })
+    merged = evaluate_model_lib.merge_subgroup_labels(ds, table, batch_size=2)
+    self.assertEmpty(merged)
+    self.assertCountEqual(
+        merged.columns.tolist(),
+        ['example_id', 'bias', 'subgroup_label', 'label'],
+    )
+
+  def test_evaluate_active_sampling(self):
+    output_dir = _make_temp_dir()
+    _write_round_table(output_dir, 0, 'bias_table.csv', pd.DataFrame({
+        'example_id': ['a', 'b', 'c', 'd', 'e', 'unmatched'],
+        'bias': [0.1, 0.2, 0.3, 0.4, 0.5, 0.6],
+    }))
+    _write_round_table(output_dir, 1, 'bias_table.csv', pd.DataFrame({
+        'example_id': ['f', 'b', 'unmatched'],
+        'bias': [0.7, 0.8, 0.9],
+    }))
+    with mock.patch.object(
+        evaluate_model_lib,
+        '_read_subgroup_labels',
+        wraps=evaluate_model_lib._read_subgroup_labels,
+    ) as read_subgroup_labels:
+      results = evaluate_model_lib.evaluate_active_sampling(
+          2, output_dir, _make_dataloader(), batch_size=4, num_subgroups=3
+      )
+    # The training labels are read once for all rounds.
+    read_subgroup_labels.assert_called_once()
+    # Expected values are those computed before the vectorized rewrite.
+    # Examples with out of range subgroup labels are counted in num_samples
+    # but not in any subgroup.
+    self.assertEqual(
+        results.to_dict('list'),
+        {
+            'num_samples': [5, 5, 5, 2, 2, 2],
+            'prob_representation': [0.2, 0.4, 0.2, 0.0, 0.5, 0.0],
+            'round_idx': [0, 0, 0, 1, 1, 1],
+            'subgroup_ids': [0, 1, 2, 0, 1, 2],
+        },
+    )
+
+  def test_evaluate_model(self):
+    output_dir = _make_temp_dir()
+    _write_round_table(output_dir, 0, 'bias_table.csv', pd.DataFrame({
+        'example_id': ["b'a'", "b'c'", "b'g'", "b'unmatched'"],
+        'bias': [0.1, 0.2, 0.3, 0.4],
+    }))
+    _write_round_table(output_dir, 0, 'predictions_table.csv', pd.DataFrame({
+        'example_id': ["b'b'", "b'a'"],
+        'label_0': [0.2, 0.4],
+        'label_1': [0.4, 0.8],
+        'bias_0': [0.1, 0.3],
+    }))
+    _write_round_table(
+        output_dir, 0, 'predictions_table_val.csv', pd.DataFrame({
+            'example_id': ["b'g'", "b'c'"],
+            'label_0': [0.5, 0.1],
+            'bias_0': [0.2, 0.6],
+        })
+    )
+    with mock.patch.object(
+        evaluate_model_lib,
+        '_read_subgroup_labels',
+        wraps=evaluate_model_lib._read_subgroup_labels,
+    ) as read_subgroup_labels:
+      results = evaluate_model_lib.evaluate_model(
+          0, output_dir, _make_dataloader(), batch_size=4
+      )
+    # The labels of each dataset are read once.
+    self.assertEqual(read_subgroup_labels.call_count, 2)
+    # Expected values are those computed before the single pass rewrite.
+    expected = {
+        'train_bias': pd.DataFrame({
+            'example_id': ['a', 'c'],
+            'bias': [0.1, 0.2],
+            'subgroup_label': [0, 1],
+            'label': [0, 0],
+        }),
+        'train_predictions': pd.DataFrame({
+            'example_id': ['b', 'a'],
+            'label_0': [0.2, 0.4],
+            'label_1': [0.4, 0.8],
+            'bias_0': [0.1, 0.3],
+            'bias': [0.1, 0.3],
+            'label_prediction': [0.3, 0.6],
+            'subgroup_label': [1, 0],
+            'label': [1, 0],
+        }),
+        'val_bias': pd.DataFrame({
+            'example_id': ['c', 'g'],
+            'bias': [0.2, 0.3],
+            'subgroup_label': [1, 0],
+            'label': [0, 1],
+        }),
+        'val_predictions': pd.DataFrame({
+            'example_id': ['g', 'c'],
+            'label_0': [0.5, 0.1],
+            'bias_0': [0.2, 0.6],
+            'bias': [0.2, 0.6],
+            'label_prediction': [0.5, 0.1],
+            'subgroup_label': [0, 1],
+            'label': [1, 0],
+        }),
+    }
+    self.assertCountEqual(results.keys(), expected.keys())
+    for name, expected_table in expected.items():
+      pd.testing.assert_frame_equal(
+          results[name], expected_table, obj=name
+      )
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -33,6 +33,22 @@ flags.DEFINE_string('worker_type', 'c3-standard-8', 'Dataflow worker type.')
 flags.DEFINE_list(
     'text_labels', ['intact buildings', 'damaged buildings'], 'Text labels.'
 )
+flags.DEFINE_bool(
+    'use_tensorrt',
+    False,
+    'If true, convert the model with TF-TRT at FP16 precision on GPU workers.',
+)
+flags.DEFINE_bool(
+    'jit_compile',
+    True,
+    'If true, compile the model with XLA for a fixed batch size.',
+)
+flags.DEFINE_float(
+    'max_batch_delay_secs',
+    None,
+    'If set, partial batches from different bundles are coalesced into full '
+    'batches, waiting at most this many seconds for more examples.',
+)
 
 
 def main(_) -> None:
@@ -59,6 +75,9 @@ def main(_) -> None:
       FLAGS.batch_size,
       FLAGS.text_labels,
       pipeline_options,
+      FLAGS.use_tensorrt,
+      FLAGS.jit_compile,
+      FLAGS.max_batch_delay_secs,
   )
 
 
@@ -1,19 +1,23 @@
 """Functions for running model inference in beam."""
 
+import collections
+import concurrent.futures
+import os
+import threading
 import time
-from typing import Any, Iterator, Optional
+from typing import Any, Callable, Iterator, Optional, Sequence
 
+from absl import logging
 import apache_beam as beam
 from apache_beam.utils import multi_process_shared
+from apache_beam.utils import shared
+from apache_beam.utils import windowed_value
+import cv2
 import numpy as np
 from skai import utils
-from skai.model import data
 import tensorflow as tf
 
 
-import tensorflow_text  # pylint: disable=unused-import
-
-
 class InferenceModel(object):
   """Abstract base class for an inference model.
 
@@ -27,30 +31,201 @@ class InferenceModel(object):
     """
     raise NotImplementedError()
 
+  def release_model(self) -> None:
+    """Releases resources acquired in prepare_model.
+
+    This function will be called in the teardown function of the DoFn.
+    """
+
   def predict_scores(self, batch: list[tf.train.Example]) -> np.ndarray:
     """Predicts scores for a batch of input examples."""
     raise NotImplementedError()
 
+  def prepare_inputs(self, batch: list[tf.train.Example]) -> Any:
+    """Converts a batch of input examples into model inputs.
+
+    Together with predict_scores_from_inputs, this splits predict_scores into
+    a preprocessing step and a model step, so that ModelInference can prepare
+    the next batch while the model runs on the current one. By default, the
+    examples are passed through and scored by predict_scores.
+
+    Args:
+      batch: Input examples.
+
+    Returns:
+      Model inputs to pass to predict_scores_from_inputs.
+    """
+    return batch
+
+  def predict_scores_from_inputs(self, inputs: Any) -> np.ndarray:
+    """Predicts scores for model inputs returned by prepare_inputs."""
+    return self.predict_scores(inputs)
+
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Maximum number of image decoding threads per process. Runners such as
+# Dataflow start one SDK process per vCPU, each with many DoFn threads, so the
+# pool is shared by all DoFns in a process and kept small.
+_MAX_DECODE_THREADS = 4
+
+_decode_pool_lock = threading.Lock()
+_decode_pool = None
+_decode_pool_users = 0
+
+
+def _acquire_decode_pool() -> concurrent.futures.ThreadPoolExecutor:
+  """Returns the process-wide image decoding pool, creating it if needed."""
+  global _decode_pool, _decode_pool_users
+  with _decode_pool_lock:
+    if _decode_pool is None:
+      _decode_pool = concurrent.futures.ThreadPoolExecutor(
+          max_workers=min(_MAX_DECODE_THREADS, os.cpu_count() or 1)
+      )
+    _decode_pool_users += 1
+    return _decode_pool
+
 
-def _extract_image_or_blank(
-    example: tf.train.Example, feature: str, image_size: int
+def _release_decode_pool() -> None:
+  """Releases the decoding pool, shutting it down when it has no more users."""
+  global _decode_pool, _decode_pool_users
+  with _decode_pool_lock:
+    _decode_pool_users -= 1
+    if _decode_pool_users == 0:
+      _decode_pool.shutdown()
+      _decode_pool = None
+
+
+# Image features read by TF2InferenceModel, in the order they are unpacked.
+_IMAGE_FEATURES = (
+    'pre_image_png',
+    'post_image_png',
+    'pre_image_png_large',
+    'post_image_png_large',
+)
+
+
+def _decode_and_resize_image(
+    image_bytes: bytes, image_size: int, out: Optional[np.ndarray] = None
 ) -> np.ndarray:
-  """Extracts an image from a TF Example.
+  """Decodes an image into a float32 RGB array with values in [0, 1].
+
+  Images are resized with OpenCV, which gives the same result as
+  data.decode_and_resize_image without the overhead of running eager TF ops
+  per image. PNG images are also decoded with OpenCV. Other formats are decoded
+  with TF, since OpenCV's JPEG decoder does not exactly match the one used in
+  training. Either way, images are decoded as uint8 and only converted to
+  float32 when they are written to the output.
+
+  Args:
+    image_bytes: Encoded image.
+    image_size: Size to resize the image to.
+    out: Optional array of shape (image_size, image_size, 3) to write the image
+      to. It may be a view into a larger array, such as half of the channels of
+      a 6-channel image.
+
+  Returns:
+    Image as a numpy array of shape (image_size, image_size, 3). This is out if
+    it was given.
+  """
+  image = None
+  if image_bytes.startswith(_PNG_SIGNATURE):
+    image = cv2.imdecode(
+        np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR
+    )
+  if image is None:
+    image = tf.io.decode_image(
+        image_bytes, channels=3, expand_animations=False
+    ).numpy()
+  else:
+    # Reverse the channels from OpenCV's BGR order to RGB while scaling.
+    image = image[..., ::-1]
+  if image.shape[:2] == (image_size, image_size):
+    # Write the scaled image directly to the output.
+    return np.multiply(image, 1 / 255, out=out, dtype=np.float32)
+  image = cv2.resize(
+      np.multiply(image, 1 / 255, dtype=np.float32),
+      (image_size, image_size),
+      interpolation=cv2.INTER_LINEAR,
+  )
+  if out is None:
+    return image
+  out[...] = image
+  return out
+
+
+def _get_image_bytes(
+    example: tf.train.Example, features: Sequence[str]
+) -> list[Optional[bytes]]:
+  """Reads encoded images from a TF Example.
+
+  Args:
+    example: Example to read images from.
+    features: Image feature names.
 
-  If the image feature is missing, returns a blank image instead.
+  Returns:
+    Encoded image for each feature, or None if the feature is missing or empty.
+  """
+  feature_map = example.features.feature
+  image_bytes = []
+  for feature in features:
+    # A single map lookup, instead of a membership test followed by indexing.
+    values = feature_map.get(feature)
+    if values is not None:
+      values = values.bytes_list.value
+    image_bytes.append(values[0] if values else None)
+  return image_bytes
+
+
+def _compile_for_input(
+    model: Callable[[dict[str, Any]], Any], model_input: dict[str, np.ndarray]
+) -> Callable[[dict[str, Any]], Any]:
+  """Compiles a model with XLA for inputs shaped like model_input.
 
   Args:
-    example: Example to extract image from.
-    feature: Image feature name.
-    image_size: Image size.
+    model: Model to compile.
+    model_input: Example input. The compiled model only accepts inputs with the
+      same shapes.
 
   Returns:
-    Image as a numpy array, or an array of 0s if image feature is missing.
+    The compiled model, or the original model if it could not be compiled.
   """
-  if feature in example.features.feature:
-    image_bytes = utils.get_bytes_feature(example, feature)[0]
-    return data.decode_and_resize_image(image_bytes, image_size).numpy()
-  return np.zeros((image_size, image_size, 3), dtype=np.float32)
+  compiled_model = tf.function(
+      model,
+      input_signature=[{
+          name: tf.TensorSpec(value.shape, tf.float32)
+          for name, value in model_input.items()
+      }],
+      jit_compile=True,
+  )
+  try:
+    _ = compiled_model(model_input)
+  except (tf.errors.OpError, TypeError, ValueError) as e:
+    logging.warning('Could not compile model with XLA, not using it: %s', e)
+    return model
+  return compiled_model
+
+
+def _load_saved_model(model_dir: str) -> Any:
+  """Loads a SavedModel, registering tensorflow_text ops only if needed.
+
+  tensorflow_text is large and only used by vision language models, so it is
+  imported lazily instead of on every worker.
+
+  Args:
+    model_dir: Saved model directory.
+
+  Returns:
+    The loaded model.
+  """
+  try:
+    return tf.saved_model.load(model_dir)
+  except (tf.errors.NotFoundError, RuntimeError) as e:
+    # Depending on the TF version, unregistered ops raise either error.
+    if 'Op type not registered' not in str(e):
+      raise
+    import tensorflow_text  # pylint: disable=g-import-not-at-top,unused-import
+    return tf.saved_model.load(model_dir)
 
 
 def _get_model_type(model: tf.keras.Model) -> Optional[str]:
@@ -63,10 +238,18 @@ class TF2VLMModel:
   """VLM model wrapper for SKAI TF2 models."""
 
   def __init__(self, model: tf.keras.Model, text_labels: list[str]):
+    # Text encoding needs the tensorflow_text ops.
+    import tensorflow_text  # pylint: disable=g-import-not-at-top,unused-import
     self._model = model
     self.labels_embeddings = self._model.encode_texts(
         tf.convert_to_tensor(text_labels)
     )
+    # TODO(mohammedelfatihsalah): take the temperature value from the saved tf model.
+    # The label embeddings are fixed, so transpose and scale them by the
+    # temperature once instead of on every batch.
+    self._logit_weights = tf.constant(
+        tf.transpose(self.labels_embeddings).numpy() * 100.0
+    )
 
   def __call__(self, batch: dict[str, Any]) -> dict[str, tf.Tensor]:
     """Predicts probabilities for a batch of images.
@@ -79,20 +262,95 @@ class TF2VLMModel:
       a dictionary that contains probabilities of labels for
       each image example.
     """
+    return {'main': self._predict_probs(batch['large_image'])}
+
+  @tf.function
+  def _predict_probs(self, images: tf.Tensor) -> tf.Tensor:
     # TODO(mohammedelfatihsalah): check the image size requirement of the save tf model.
-    image_embeddings = self._model.encode_images(batch['large_image']*255)
-    # TODO(mohammedelfatihsalah): take the temperature value from the saved tf model.
-    sims = image_embeddings @ tf.transpose(self.labels_embeddings) * 100
-    probs = tf.nn.softmax(sims, axis=-1)
-    return {'main': probs}
+    image_embeddings = self._model.encode_images(images * 255.0)
+    return tf.nn.softmax(image_embeddings @ self._logit_weights, axis=-1)
+
+
+# Subdirectory of the model directory that holds the int8 TFLite export.
+QUANTIZED_MODEL_SUBDIR = 'int8'
+_TFLITE_MODEL_FILE = 'model.tflite'
+
+
+def get_quantized_model_path(model_dir: str) -> str:
+  return os.path.join(model_dir, QUANTIZED_MODEL_SUBDIR, _TFLITE_MODEL_FILE)
+
+
+class TFLiteModel:
+  """Wrapper that calls a TFLite model in the same way as a TF2 SavedModel."""
+
+  def __init__(self, model_path: str):
+    with tf.io.gfile.GFile(model_path, 'rb') as f:
+      model_content = f.read()
+    self._interpreter = tf.lite.Interpreter(
+        model_content=model_content, num_threads=os.cpu_count()
+    )
+    self._runner = self._interpreter.get_signature_runner()
+    # TFLite interpreters are not thread-safe.
+    self._lock = threading.Lock()
+
+  def __call__(self, batch: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    with self._lock:
+      return self._runner(**batch)
+
+
+class TensorRTModel:
+  """Wrapper that calls a TF-TRT converted signature like a TF2 SavedModel."""
+
+  def __init__(self, converted_function: Callable[..., dict[str, tf.Tensor]]):
+    self._converted_function = converted_function
+
+  def __call__(self, batch: dict[str, Any]) -> dict[str, tf.Tensor]:
+    return self._converted_function(**batch)
+
+
+def _convert_with_tensorrt(
+    model_dir: str, model_input: dict[str, np.ndarray]
+) -> Optional[TensorRTModel]:
+  """Converts a SavedModel with TF-TRT for inputs shaped like model_input.
+
+  The TensorRT engines are built at FP16 precision for the shapes of
+  model_input, so inputs should be padded to the same batch size.
+
+  Args:
+    model_dir: Saved model directory.
+    model_input: Example input.
+
+  Returns:
+    The converted model, or None if there is no GPU or the conversion fails.
+  """
+  if not tf.config.list_physical_devices('GPU'):
+    logging.warning('No GPU found, not converting model with TF-TRT.')
+    return None
+  try:
+    converter = tf.experimental.tensorrt.Converter(
+        input_saved_model_dir=model_dir, precision_mode='FP16'
+    )
+    converted_function = converter.convert()
+    converter.build(input_fn=lambda: [model_input])
+  except (ImportError, RuntimeError, ValueError, tf.errors.OpError) as e:
+    logging.warning(
+        'Could not convert model with TF-TRT, using SavedModel instead: %s', e
+    )
+    return None
+  return TensorRTModel(converted_function)
 
 
 class TF2InferenceModel(InferenceModel):
-  """InferenceModel wrapper for SKAI TF2 models."""
+  """InferenceModel wrapper for SKAI TF2 models.
+
+  If the model directory contains an int8 export written by quantize_model, it
+  is used instead of the full precision SavedModel.
+  """
 
   _model_dir: str
   _image_size: int
   _post_image_only: bool
+  _batch_size: Optional[int]
   _model: Any
 
   def __init__(
@@ -101,48 +359,80 @@ class TF2InferenceModel(InferenceModel):
       image_size: int,
       post_image_only: bool,
       text_labels: list[str],
+      batch_size: Optional[int] = None,
+      use_tensorrt: bool = False,
+      jit_compile: bool = True,
   ):
+    """Constructor.
+
+    Args:
+      model_dir: Saved model directory.
+      image_size: Image width and height expected by the model.
+      post_image_only: Model expects only post-disaster images.
+      text_labels: Text labels used by vision language models.
+      batch_size: If set, smaller batches are padded up to this batch size, so
+        that the model always runs on inputs of the same shape.
+      use_tensorrt: If true, on GPU workers the model is converted with TF-TRT
+        at FP16 precision, which changes scores slightly. Vision language
+        models are never converted. If there is no GPU or the conversion
+        fails, the SavedModel is used as is.
+      jit_compile: If true and batch_size is set, the model is compiled with
+        XLA for that batch size.
+    """
     self._model_dir = model_dir
     self._image_size = image_size
     self._post_image_only = post_image_only
     self._text_labels = text_labels
+    self._batch_size = batch_size
+    self._use_tensorrt = use_tensorrt
+    self._jit_compile = jit_compile
     self._model = None
+    self._decode_pool = None
 
-  def _make_dummy_input(self):
+  def _make_image_batch(self, batch_size: int) -> np.ndarray:
+    # Zero-initialized, so that missing images and padding rows are blank
+    # without having to write to them.
     num_channels = 3 if self._post_image_only else 6
-    image = np.zeros(
-        (1, self._image_size, self._image_size, num_channels), dtype=np.float32
+    return np.zeros(
+        (batch_size, self._image_size, self._image_size, num_channels),
+        dtype=np.float32,
     )
+
+  def _make_dummy_input(self):
+    image = self._make_image_batch(self._batch_size or 1)
     return {'small_image': image, 'large_image': image}
 
-  def _extract_images_or_blanks(
+  def _decode_tasks(
       self,
-      example: tf.train.Example,
-      pre_image_feature: str,
-      post_image_feature: str,
-  ) -> np.ndarray:
-    """Extracts pre and post disaster images from an example.
+      pre_image_bytes: Optional[bytes],
+      post_image_bytes: Optional[bytes],
+      out: np.ndarray,
+  ) -> list[tuple[bytes, np.ndarray]]:
+    """Pairs the pre and post disaster images of an example with their outputs.
 
-    If the image feature is not present, this function will use a blank image
-    (all zeros) as a placeholder.
+    Missing images are skipped, leaving their outputs blank (all zeros).
 
     Args:
-      example: Example to extract the image from.
-      pre_image_feature: Name of feature storing the pre-disaster image byte.
-      post_image_feature: Name of feature storing the post-disaster image byte.
+      pre_image_bytes: Encoded pre-disaster image, or None.
+      post_image_bytes: Encoded post-disaster image, or None.
+      out: Array to write the images to. The pre-disaster image is written to
+        the first 3 channels and the post-disaster image to the last 3.
 
     Returns:
-      Numpy array representing the concatenated images.
+      List of (encoded image, output array) tuples.
     """
-    post_image = _extract_image_or_blank(
-        example, post_image_feature, self._image_size
-    )
     if self._post_image_only:
-      return post_image
-    pre_image = _extract_image_or_blank(
-        example, pre_image_feature, self._image_size
-    )
-    return np.concatenate([pre_image, post_image], axis=2)
+      tasks = [(post_image_bytes, out)]
+    else:
+      tasks = [
+          (pre_image_bytes, out[..., :3]),
+          (post_image_bytes, out[..., 3:]),
+      ]
+    return [task for task in tasks if task[0] is not None]
+
+  def _decode_into(self, task: tuple[bytes, np.ndarray]) -> None:
+    image_bytes, out = task
+    _decode_and_resize_image(image_bytes, self._image_size, out)
 
   def prepare_model(self) -> None:
     # Use a shared handle so that the model is only loaded once per worker and
@@ -150,56 +440,300 @@ class TF2InferenceModel(InferenceModel):
     #
     # https://medium.com/google-cloud/cache-reuse-across-dofns-in-beam-a34a926db848
     def load():
-      model = tf.saved_model.load(self._model_dir)
+      quantized_model_path = get_quantized_model_path(self._model_dir)
+      if tf.io.gfile.exists(quantized_model_path):
+        logging.info('Using quantized model %s', quantized_model_path)
+        return TFLiteModel(quantized_model_path)
+      model = _load_saved_model(self._model_dir)
       if _get_model_type(model) == 'vlm':
-        vlm_model = TF2VLMModel(model, self._text_labels)
-        _ = vlm_model(self._make_dummy_input())
-        return vlm_model
-      else:
-        # Call predict once to make sure any hidden lazy initialization is
-        # triggered. See https://stackoverflow.com/a/43393252
-        _ = model(self._make_dummy_input())
-        return model
+        if self._use_tensorrt:
+          logging.warning(
+              'TF-TRT is not supported for vision language models, not'
+              ' converting model.'
+          )
+        model = TF2VLMModel(model, self._text_labels)
+      elif self._use_tensorrt:
+        tensorrt_model = _convert_with_tensorrt(
+            self._model_dir, self._make_dummy_input()
+        )
+        if tensorrt_model:
+          return tensorrt_model
+      # Call predict once to make sure any hidden lazy initialization is
+      # triggered. See https://stackoverflow.com/a/43393252
+      _ = model(self._make_dummy_input())
+      if self._batch_size and self._jit_compile:
+        model = _compile_for_input(model, self._make_dummy_input())
+      return model
 
     self._model = (
         multi_process_shared.MultiProcessShared(load, 'share').acquire()
     )
+    # OpenCV releases the GIL while decoding and resizing, so the images of a
+    # batch can be decoded in parallel.
+    if self._decode_pool is None:
+      self._decode_pool = _acquire_decode_pool()
+
+  def release_model(self) -> None:
+    if self._decode_pool is not None:
+      self._decode_pool = None
+      _release_decode_pool()
 
   def predict_scores(self, batch: list[tf.train.Example]) -> np.ndarray:
-    model_input = self._extract_image_arrays(batch)
-    outputs = self._model(model_input)
-    return outputs['main'][:, 1]
+    return self.predict_scores_from_inputs(self.prepare_inputs(batch))
+
+  def prepare_inputs(
+      self, batch: list[tf.train.Example]
+  ) -> list[tuple[int, dict[str, np.ndarray]]]:
+    """Decodes a batch into model inputs of at most batch_size examples each.
+
+    Args:
+      batch: Input examples.
+
+    Returns:
+      List of (number of examples, model input) tuples.
+    """
+    chunk_size = self._batch_size or len(batch)
+    return [
+        (len(chunk), self._extract_image_arrays(chunk))
+        for chunk in (
+            batch[i:i + chunk_size] for i in range(0, len(batch), chunk_size)
+        )
+    ]
+
+  def predict_scores_from_inputs(
+      self, inputs: list[tuple[int, dict[str, np.ndarray]]]
+  ) -> np.ndarray:
+    scores = [
+        self._model(model_input)['main'][:num_examples, 1]
+        for num_examples, model_input in inputs
+    ]
+    return scores[0] if len(scores) == 1 else np.concatenate(scores)
 
   def _extract_image_arrays(
       self,
       examples: list[tf.train.Example],
   ) -> dict[str, np.ndarray]:
     """Reads images from a batch of examples as numpy arrays."""
-    small_images = []
-    large_images = []
-    for example in examples:
-      small_images.append(
-          self._extract_images_or_blanks(
-              example, 'pre_image_png', 'post_image_png'
-          )
-      )
-      large_images.append(
-          self._extract_images_or_blanks(
-              example, 'pre_image_png_large', 'post_image_png_large'
-          )
-      )
+    # Read all encoded images in one pass over the protos, then decode them
+    # directly into the batch arrays to avoid stacking.
+    image_bytes = [
+        _get_image_bytes(example, _IMAGE_FEATURES) for example in examples
+    ]
+    # Pad batches up to the compiled batch size with blank images.
+    num_rows = max(len(examples), self._batch_size or 0)
+    small_images = self._make_image_batch(num_rows)
+    large_images = self._make_image_batch(num_rows)
+    tasks = []
+    for i, (pre, post, pre_large, post_large) in enumerate(image_bytes):
+      tasks.extend(self._decode_tasks(pre, post, small_images[i]))
+      tasks.extend(self._decode_tasks(pre_large, post_large, large_images[i]))
+    if self._decode_pool:
+      # Consume the results so that decoding errors are raised.
+      _ = list(self._decode_pool.map(self._decode_into, tasks))
+    else:
+      for task in tasks:
+        self._decode_into(task)
     return {
-        'small_image': np.stack(small_images),
-        'large_image': np.stack(large_images),
+        'small_image': small_images,
+        'large_image': large_images,
     }
 
 
+class _PendingBatch:
+  """Examples waiting to be scored by a _BatchCoalescer."""
+
+  def __init__(self, examples: list[tf.train.Example], deadline: float):
+    self.examples = examples
+    self.deadline = deadline
+    self.scores = concurrent.futures.Future()
+
+
+class _BatchCoalescer:
+  """Coalesces the batches of concurrent callers into full model batches.
+
+  Batches formed within Beam bundles are often smaller than the batch size, for
+  example at the end of each bundle. This class lets all processing threads of
+  a worker submit their batches to a single background thread, which runs the
+  model once it has batch_size examples or when the oldest pending batch has
+  waited max_delay_secs. Submitted batches are never split between model calls.
+
+  The coalescer owns its model. Users call acquire before submitting batches
+  and release when they are done. The model is prepared and the background
+  thread started for the first user, and both are shut down after the last
+  user releases the coalescer.
+  """
+
+  def __init__(
+      self, model: InferenceModel, batch_size: int, max_delay_secs: float
+  ):
+    self._model = model
+    self._batch_size = batch_size
+    self._max_delay_secs = max_delay_secs
+    self._pending = collections.deque()
+    self._num_pending_examples = 0
+    self._condition = threading.Condition()
+    # Held while starting or stopping, so that a new thread is never started
+    # while the previous one is still shutting down.
+    self._users_lock = threading.Lock()
+    self._num_users = 0
+    self._stopping = False
+    self._thread = None
+
+  def acquire(self) -> None:
+    """Registers a user, starting the coalescer if it is the first one."""
+    with self._users_lock:
+      if self._num_users == 0:
+        self._model.prepare_model()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+      self._num_users += 1
+
+  def release(self) -> None:
+    """Unregisters a user, stopping the coalescer if it was the last one."""
+    with self._users_lock:
+      self._num_users -= 1
+      if self._num_users:
+        return
+      with self._condition:
+        self._stopping = True
+        self._condition.notify()
+      self._thread.join()
+      self._thread = None
+      self._model.release_model()
+
+  def predict_scores(self, examples: list[tf.train.Example]) -> np.ndarray:
+    """Predicts scores for examples, possibly batched with other callers."""
+    batch = _PendingBatch(examples, time.monotonic() + self._max_delay_secs)
+    with self._condition:
+      self._pending.append(batch)
+      self._num_pending_examples += len(examples)
+      self._condition.notify()
+    return batch.scores.result()
+
+  def _is_ready(self) -> bool:
+    return bool(self._pending) and (
+        self._num_pending_examples >= self._batch_size
+        or time.monotonic() >= self._pending[0].deadline
+    )
+
+  def _take_batches(self) -> list[_PendingBatch]:
+    batches = [self._pending.popleft()]
+    num_examples = len(batches[0].examples)
+    while (
+        self._pending
+        and num_examples + len(self._pending[0].examples) <= self._batch_size
+    ):
+      batches.append(self._pending.popleft())
+      num_examples += len(batches[-1].examples)
+    self._num_pending_examples -= num_examples
+    return batches
+
+  def _run(self) -> None:
+    while True:
+      with self._condition:
+        while not self._is_ready():
+          if self._stopping:
+            return
+          timeout = (
+              self._pending[0].deadline - time.monotonic()
+              if self._pending
+              else None
+          )
+          self._condition.wait(timeout)
+        batches = self._take_batches()
+      try:
+        scores = self._model.predict_scores(
+            [example for batch in batches for example in batch.examples]
+        )
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        for batch in batches:
+          batch.scores.set_exception(e)
+        continue
+      offset = 0
+      for batch in batches:
+        batch.scores.set_result(
+            scores[offset:offset + len(batch.examples)]
+        )
+        offset += len(batch.examples)
+
+
+def quantize_model(
+    model_dir: str,
+    examples: Sequence[tf.train.Example],
+    image_size: int,
+    post_image_only: bool,
+) -> str:
+  """Exports an int8 TFLite version of a TF2 model.
+
+  Weights and activations are quantized to int8, with activation ranges
+  calibrated on the given examples. Inputs and outputs stay float32, so the
+  export is a drop-in replacement for the SavedModel in TF2InferenceModel.
+
+  Args:
+    model_dir: Saved model directory. The export is written to the
+      QUANTIZED_MODEL_SUBDIR subdirectory.
+    examples: Representative examples used for calibration.
+    image_size: Image width and height expected by the model.
+    post_image_only: Model expects only post-disaster images.
+
+  Returns:
+    Path of the exported model.
+
+  Raises:
+    ValueError: If the model is a vision language model.
+  """
+  if _get_model_type(_load_saved_model(model_dir)) == 'vlm':
+    raise ValueError('Quantizing vision language models is not supported.')
+  image_reader = TF2InferenceModel(model_dir, image_size, post_image_only, [])
+
+  def representative_dataset():
+    for example in examples:
+      yield image_reader._extract_image_arrays([example])  # pylint: disable=protected-access
+
+  converter = tf.lite.TFLiteConverter.from_saved_model(model_dir)
+  converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  converter.representative_dataset = representative_dataset
+  converter.target_spec.supported_types = [tf.int8]
+  model_content = converter.convert()
+
+  model_path = get_quantized_model_path(model_dir)
+  tf.io.gfile.makedirs(os.path.dirname(model_path))
+  with tf.io.gfile.GFile(model_path, 'wb') as f:
+    f.write(model_content)
+  return model_path
+
+
 class ModelInference(beam.DoFn):
   """Model inference DoFn."""
 
-  def __init__(self, score_feature: str, model: InferenceModel):
+  def __init__(
+      self,
+      score_feature: str,
+      model: InferenceModel,
+      batch_size: Optional[int] = None,
+      max_batch_delay_secs: Optional[float] = None,
+  ):
+    """Constructor.
+
+    Args:
+      score_feature: Feature name to use for inference scores.
+      model: Inference model to use.
+      batch_size: Model batch size. Required if max_batch_delay_secs is set.
+      max_batch_delay_secs: If set, batches from all threads of a worker are
+        coalesced into batches of batch_size before running the model, waiting
+        at most this long for a batch to fill up.
+    """
+    if max_batch_delay_secs is not None and not batch_size:
+      raise ValueError('batch_size must be set to coalesce batches.')
     self._score_feature = score_feature
     self._model = model
+    self._batch_size = batch_size
+    self._max_batch_delay_secs = max_batch_delay_secs
+    self._shared_coalescer = shared.Shared()
+    self._coalescer = None
+    self._prepare_pool = None
+    self._pending = None
     self._examples_processed = beam.metrics.Metrics.counter(
         'skai', 'examples_processed'
     )
@@ -211,23 +745,83 @@ class ModelInference(beam.DoFn):
     )
 
   def setup(self) -> None:
-    self._model.prepare_model()
-
-  def process(
-      self, batch: list[tf.train.Example]
-  ) -> Iterator[tf.train.Example]:
-    start_time = time.process_time()
-    scores = self._model.predict_scores(batch)
-    elapsed_millis = (time.process_time() - start_time) * 1000
-    self._inference_millis.update(elapsed_millis)
-    for example, score in zip(batch, scores):
-      output_example = tf.train.Example()
-      output_example.CopyFrom(example)
-      utils.add_float_feature(self._score_feature, score, output_example)
-      yield output_example
-
+    if self._max_batch_delay_secs is not None:
+      # The coalescer is shared by all DoFn instances of a worker and runs the
+      # model of the instance that created it, so the model of this instance
+      # is not prepared.
+      self._coalescer = self._shared_coalescer.acquire(
+          lambda: _BatchCoalescer(
+              self._model, self._batch_size, self._max_batch_delay_secs
+          )
+      )
+      self._coalescer.acquire()
+    else:
+      self._model.prepare_model()
+      self._prepare_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+  def teardown(self) -> None:
+    if self._coalescer:
+      self._coalescer.release()
+      self._coalescer = None
+    else:
+      self._prepare_pool.shutdown()
+      self._model.release_model()
+
+  def _add_scores(
+      self, batch: list[tf.train.Example], scores: np.ndarray
+  ) -> list[tf.train.Example]:
+    # Add the scores to the input examples directly instead of copying them,
+    # since copying would duplicate all of their image bytes. Converting all
+    # scores to Python floats at once avoids indexing the array per example.
+    score_floats = np.asarray(scores, dtype=np.float32).tolist()
+    for example, score in zip(batch, score_floats):
+      example.features.feature[self._score_feature].float_list.value.append(
+          score
+      )
     self._examples_processed.inc(len(batch))
     self._batches_processed.inc(1)
+    return batch
+
+  def _predict_pending(self) -> Iterator[windowed_value.WindowedValue]:
+    batch, inputs, timestamp, window = self._pending
+    self._pending = None
+    inputs = inputs.result()
+    # Measure wall time. CPU time of this process would mostly count the
+    # decoding of the next batch, which runs concurrently, and not the model,
+    # which runs in the shared model server process.
+    start_time = time.perf_counter()
+    scores = self._model.predict_scores_from_inputs(inputs)
+    elapsed_millis = (time.perf_counter() - start_time) * 1000
+    self._inference_millis.update(elapsed_millis)
+    for example in self._add_scores(batch, scores):
+      yield windowed_value.WindowedValue(
+          example, timestamp, [window]
+      )
+
+  def process(
+      self,
+      batch: list[tf.train.Example],
+      timestamp=beam.DoFn.TimestampParam,
+      window=beam.DoFn.WindowParam,
+  ) -> Iterator[Any]:
+    if self._coalescer:
+      start_time = time.perf_counter()
+      scores = self._coalescer.predict_scores(batch)
+      elapsed_millis = (time.perf_counter() - start_time) * 1000
+      self._inference_millis.update(elapsed_millis)
+      yield from self._add_scores(batch, scores)
+      return
+
+    # Hold each batch back by one call, so that the next batch is prepared
+    # while the model runs on this one.
+    inputs = self._prepare_pool.submit(self._model.prepare_inputs, batch)
+    if self._pending:
+      yield from self._predict_pending()
+    self._pending = (batch, inputs, timestamp, window)
+
+  def finish_bundle(self) -> Iterator[windowed_value.WindowedValue]:
+    if self._pending:
+      yield from self._predict_pending()
 
 
 def run_inference(
@@ -235,14 +829,28 @@ def run_inference(
     score_feature: str,
     batch_size: int,
     model: InferenceModel,
+    max_batch_delay_secs: Optional[float] = None,
+    fixed_batch_size: bool = False,
 ) -> beam.PCollection:
   """Runs inference and augments input examples with inference scores.
 
+  The scores are added to the input examples in place, so the input
+  PCollection should not be consumed by any other transforms.
+
   Args:
     examples: PCollection of Tensorflow Examples.
     score_feature: Feature name to use for inference scores.
-    batch_size: Batch size.
+    batch_size: Upper bound on the batch size. Unless fixed_batch_size is set,
+      batch sizes are adapted to how long inference takes, with
+      batch_size // 2 as the target minimum. Smaller batches can still occur,
+      for example at the end of a bundle.
     model: Inference model to use.
+    max_batch_delay_secs: If set, partial batches from different bundles are
+      coalesced into full batches, waiting at most this long for more examples.
+    fixed_batch_size: If true, batches are not adapted and always have
+      batch_size examples, except at the end of a bundle. Use this for models
+      that pad smaller batches up to batch_size, since padded batches all take
+      the same time and the padding rows are wasted work.
 
   Returns:
     PCollection of Tensorflow Examples augmented with inference scores.
@@ -251,9 +859,19 @@ def run_inference(
       examples
       | 'batch'
       >> beam.transforms.util.BatchElements(
-          min_batch_size=batch_size, max_batch_size=batch_size
+          min_batch_size=(
+              batch_size if fixed_batch_size else max(1, batch_size // 2)
+          ),
+          max_batch_size=batch_size,
+          target_batch_overhead=0.05,
+          target_batch_duration_secs=1,
+      )
+      | 'inference'
+      >> beam.ParDo(
+          ModelInference(
+              score_feature, model, batch_size, max_batch_delay_secs
+          )
       )
-      | 'inference' >> beam.ParDo(ModelInference(score_feature, model))
   )
 
 
@@ -271,10 +889,12 @@ def examples_to_csv(examples: beam.PCollection, output_prefix: str) -> None:
     examples: PCollection of Tensorflow Examples.
     output_prefix: Prefix of output path.
   """
+  # Format the rows before reshuffling so that only the short CSV lines, and
+  # not the examples with all their image bytes, are shuffled.
   _ = (
       examples
-      | 'reshuffle_for_output' >> beam.Reshuffle()
       | 'examples_to_csv_lines' >> beam.Map(_format_example_to_csv_row)
+      | 'reshuffle_for_output' >> beam.Reshuffle()
       | 'write_csv'
       >> beam.io.textio.WriteToText(output_prefix, file_name_suffix='.csv')
   )
@@ -288,7 +908,10 @@ def run_tf2_inference_with_csv_output(
     post_image_only: bool,
     batch_size: int,
     text_labels: list[str],
-    pipeline_options):
+    pipeline_options,
+    use_tensorrt: bool = False,
+    jit_compile: bool = True,
+    max_batch_delay_secs: Optional[float] = None):
   """Runs example generation pipeline using TF2 model and outputs to CSV.
 
   Args:
@@ -301,6 +924,10 @@ def run_tf2_inference_with_csv_output(
     text_labels: list of text labels that will be used by the vision langauge
       model.
     pipeline_options: Dataflow pipeline options.
+    use_tensorrt: If true, convert the model with TF-TRT on GPU workers.
+    jit_compile: If true, compile the model with XLA for batch_size.
+    max_batch_delay_secs: If set, partial batches from different bundles are
+      coalesced into full batches, waiting at most this long for more examples.
   """
 
   with beam.Pipeline(options=pipeline_options) as pipeline:
@@ -311,8 +938,24 @@ def run_tf2_inference_with_csv_output(
             examples_pattern, coder=beam.coders.ProtoCoder(tf.train.Example))
         | 'reshuffle_input' >> beam.Reshuffle()
     )
+    # XLA and TF-TRT both specialize the model for one input shape, so
+    # batches are padded to batch_size and formed at that size.
+    pad_batches = jit_compile or use_tensorrt
     model = TF2InferenceModel(
-        model_dir, image_size, post_image_only, text_labels
+        model_dir,
+        image_size,
+        post_image_only,
+        text_labels,
+        batch_size if pad_batches else None,
+        use_tensorrt,
+        jit_compile,
+    )
+    scored_examples = run_inference(
+        examples,
+        'score',
+        batch_size,
+        model,
+        max_batch_delay_secs=max_batch_delay_secs,
+        fixed_batch_size=pad_batches,
     )
-    scored_examples = run_inference(examples, 'score', batch_size, model)
     examples_to_csv(scored_examples, output_prefix)
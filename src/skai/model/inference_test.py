@@ -1,7 +1,11 @@
 """Tests for inference_lib."""
 
+import concurrent.futures
 import os
+import subprocess
+import sys
 import tempfile
+from unittest import mock
 
 from absl.testing import absltest
 import apache_beam as beam
@@ -9,6 +13,7 @@ from apache_beam.testing import test_pipeline
 from apache_beam.testing.util import assert_that
 import numpy as np
 from skai import utils
+from skai.model import data
 from skai.model import inference_lib
 import tensorflow as tf
 
@@ -35,6 +40,37 @@ def _create_test_model(model_path: str, image_size: int):
   tf.saved_model.save(model, model_path)
 
 
+class _TestVLM(tf.Module):
+  """Vision language model that embeds images by their mean color."""
+
+  def __init__(self):
+    super().__init__()
+    self.model_type = tf.Variable('vlm')
+
+  @tf.function(input_signature=[tf.TensorSpec([None], tf.string)])
+  def encode_texts(self, texts):
+    return tf.one_hot(tf.strings.length(texts) % 3, 3)
+
+  @tf.function(input_signature=[tf.TensorSpec([None, None, None, 3])])
+  def encode_images(self, images):
+    return tf.reduce_mean(images, axis=[1, 2]) / 255.0
+
+
+def _create_test_vlm(model_path: str):
+  tf.saved_model.save(_TestVLM(), model_path)
+
+
+class _UnsharedModel:
+  """Replacement for MultiProcessShared that loads a new model every time."""
+
+  def __init__(self, constructor, tag):
+    del tag
+    self._constructor = constructor
+
+  def acquire(self):
+    return self._constructor()
+
+
 def _create_test_example(
     image_size: int, include_small_images: bool
 ) -> tf.train.Example:
@@ -75,6 +111,46 @@ class TestModel(inference_lib.InferenceModel):
     return np.ones((self._expected_batch_size,)) * self._score
 
 
+class IdScoreModel(inference_lib.InferenceModel):
+  """Test model that scores each example with its id and records batches."""
+
+  def __init__(self):
+    self.batch_sizes = []
+    self.num_prepared = 0
+
+  def prepare_model(self):
+    self.num_prepared += 1
+
+  def release_model(self):
+    self.num_prepared -= 1
+
+  def predict_scores(self, batch: list[tf.train.Example]) -> np.ndarray:
+    self.batch_sizes.append(len(batch))
+    return np.array(
+        [e.features.feature['int64_id'].int64_list.value[0] for e in batch],
+        dtype=np.float32,
+    )
+
+
+class BatchSizeScoreModel(inference_lib.InferenceModel):
+  """Test model that scores each example with the size of its batch."""
+
+  def prepare_model(self):
+    pass
+
+  def predict_scores(self, batch: list[tf.train.Example]) -> np.ndarray:
+    return np.full((len(batch),), len(batch), dtype=np.float32)
+
+
+def _create_id_examples(start: int, end: int) -> list[tf.train.Example]:
+  examples = []
+  for example_id in range(start, end):
+    example = tf.train.Example()
+    utils.add_int64_feature('int64_id', example_id, example)
+    examples.append(example)
+  return examples
+
+
 class InferenceTest(absltest.TestCase):
 
   def test_run_inference(self):
@@ -105,11 +181,143 @@ class InferenceTest(absltest.TestCase):
 
       assert_that(result, _check_examples)
 
+  def test_run_inference_scores_match_examples(self):
+    # Batches are scored one call after they are received, so this checks that
+    # scores are added to the right examples, including in finish_bundle.
+    with test_pipeline.TestPipeline() as pipeline:
+      examples_collection = pipeline | beam.Create(_create_id_examples(0, 10))
+      result = inference_lib.run_inference(
+          examples_collection, 'score', 4, IdScoreModel()
+      )
+
+      def _check_examples(examples):
+        assert (
+            len(examples) == 10
+        ), f'Expected 10 examples in output, got {len(examples)}'
+        for example in examples:
+          features = example.features.feature
+          assert (
+              features['score'].float_list.value[0]
+              == features['int64_id'].int64_list.value[0]
+          )
+
+      assert_that(result, _check_examples)
+
+  def test_run_inference_fixed_batch_size(self):
+    with test_pipeline.TestPipeline() as pipeline:
+      examples_collection = pipeline | beam.Create(_create_id_examples(0, 10))
+      result = inference_lib.run_inference(
+          examples_collection,
+          'score',
+          4,
+          BatchSizeScoreModel(),
+          fixed_batch_size=True,
+      )
+
+      def _check_batch_sizes(examples):
+        batch_sizes = [
+            e.features.feature['score'].float_list.value[0] for e in examples
+        ]
+        # Only the last batch of the bundle is smaller.
+        assert sorted(batch_sizes) == [2] * 2 + [4] * 8, batch_sizes
+
+      assert_that(result, _check_batch_sizes)
+
+  def test_run_inference_coalesced(self):
+    with test_pipeline.TestPipeline() as pipeline:
+      examples_collection = pipeline | beam.Create(_create_id_examples(0, 10))
+      result = inference_lib.run_inference(
+          examples_collection,
+          'score',
+          4,
+          IdScoreModel(),
+          max_batch_delay_secs=0.01,
+      )
+
+      def _check_examples(examples):
+        assert (
+            len(examples) == 10
+        ), f'Expected 10 examples in output, got {len(examples)}'
+        for example in examples:
+          features = example.features.feature
+          assert (
+              features['score'].float_list.value[0]
+              == features['int64_id'].int64_list.value[0]
+          )
+
+      assert_that(result, _check_examples)
+
+  def test_batch_coalescer(self):
+    model = IdScoreModel()
+    coalescer = inference_lib._BatchCoalescer(model, 8, 0.5)
+    coalescer.acquire()
+    self.addCleanup(coalescer.release)
+    batches = [
+        _create_id_examples(0, 3),
+        _create_id_examples(3, 6),
+        _create_id_examples(6, 8),
+        _create_id_examples(8, 9),
+    ]
+    with concurrent.futures.ThreadPoolExecutor(len(batches)) as executor:
+      scores = list(executor.map(coalescer.predict_scores, batches))
+    for batch, batch_scores in zip(batches, scores):
+      np.testing.assert_array_equal(
+          batch_scores,
+          [e.features.feature['int64_id'].int64_list.value[0] for e in batch],
+      )
+    self.assertEqual(sum(model.batch_sizes), 9)
+    self.assertLessEqual(max(model.batch_sizes), 8)
+    self.assertLess(len(model.batch_sizes), len(batches))
+
+  def test_batch_coalescer_stops_after_last_release(self):
+    model = IdScoreModel()
+    coalescer = inference_lib._BatchCoalescer(model, 8, 0.01)
+    coalescer.acquire()
+    coalescer.acquire()
+    thread = coalescer._thread
+    self.assertEqual(model.num_prepared, 1)
+    coalescer.release()
+    self.assertTrue(thread.is_alive())
+    np.testing.assert_array_equal(
+        coalescer.predict_scores(_create_id_examples(0, 2)), [0, 1]
+    )
+    coalescer.release()
+    self.assertFalse(thread.is_alive())
+    self.assertEqual(model.num_prepared, 0)
+
+    # The coalescer can be started again.
+    coalescer.acquire()
+    np.testing.assert_array_equal(
+        coalescer.predict_scores(_create_id_examples(2, 3)), [2]
+    )
+    coalescer.release()
+    self.assertEqual(model.num_prepared, 0)
+
+  def test_examples_to_csv(self):
+    examples = []
+    for example_id, score in [('a', 0.25), ('b', 0.75)]:
+      example = tf.train.Example()
+      utils.add_bytes_feature('example_id', example_id.encode(), example)
+      utils.add_float_list_feature('coordinates', [1.5, 2.5], example)
+      utils.add_float_feature('score', score, example)
+      examples.append(example)
+    output_prefix = os.path.join(_make_temp_dir(), 'output')
+    with test_pipeline.TestPipeline() as pipeline:
+      inference_lib.examples_to_csv(
+          pipeline | beam.Create(examples), output_prefix
+      )
+    lines = []
+    for path in tf.io.gfile.glob(f'{output_prefix}*.csv'):
+      with tf.io.gfile.GFile(path) as f:
+        lines.extend(f.read().splitlines())
+    self.assertCountEqual(lines, ['a,1.5,2.5,0.25', 'b,1.5,2.5,0.75'])
+
   def test_tf2_model_prediction(self):
     model_path = os.path.join(_make_temp_dir(), 'model.keras')
     _create_test_model(model_path, 224)
     model = inference_lib.TF2InferenceModel(model_path, 224, False, [])
     model.prepare_model()
+    self.addCleanup(model.release_model)
 
     examples = [_create_test_example(224, True) for i in range(3)]
     output_examples = model.predict_scores(examples)
@@ -120,11 +328,187 @@ class InferenceTest(absltest.TestCase):
     _create_test_model(model_path, 224)
     model = inference_lib.TF2InferenceModel(model_path, 224, False, [])
     model.prepare_model()
+    self.addCleanup(model.release_model)
 
     examples = [_create_test_example(224, False) for i in range(3)]
     output_examples = model.predict_scores(examples)
     self.assertEqual(output_examples.shape, (3,))
 
+  def test_tf2_model_prediction_compiled(self):
+    model_path = os.path.join(_make_temp_dir(), 'model.keras')
+    _create_test_model(model_path, 224)
+    model = inference_lib.TF2InferenceModel(
+        model_path, 224, False, [], batch_size=4
+    )
+    model.prepare_model()
+    self.addCleanup(model.release_model)
+
+    # Batches smaller and larger than the compiled batch size.
+    for num_examples in [3, 6]:
+      examples = [_create_test_example(224, True) for _ in range(num_examples)]
+      output_examples = model.predict_scores(examples)
+      self.assertEqual(output_examples.shape, (num_examples,))
+
+  def test_tf2_vlm_prediction_with_tensorrt_is_not_converted(self):
+    model_path = _make_temp_dir()
+    _create_test_vlm(model_path)
+    # Labels are embedded by their length, so the green image below matches
+    # the second label.
+    text_labels = ['bb', 'a']
+    example = tf.train.Example()
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    image[..., 1] = 255
+    utils.add_bytes_feature(
+        'post_image_png_large', tf.image.encode_png(image).numpy(), example
+    )
+    with mock.patch.object(
+        inference_lib.multi_process_shared, 'MultiProcessShared', _UnsharedModel
+    ), mock.patch.object(
+        inference_lib, '_convert_with_tensorrt', autospec=True
+    ) as convert_with_tensorrt:
+      model = inference_lib.TF2InferenceModel(
+          model_path, 8, True, text_labels, use_tensorrt=True
+      )
+      model.prepare_model()
+      self.addCleanup(model.release_model)
+      scores = model.predict_scores([example])
+    convert_with_tensorrt.assert_not_called()
+    self.assertIsInstance(model._model, inference_lib.TF2VLMModel)
+    # The logits are scaled by 100.
+    np.testing.assert_allclose(scores, [1 / (1 + np.exp(-100.0))], rtol=1e-5)
+
+  def test_tf2_model_prediction_padded_without_jit_compile(self):
+    model_path = _make_temp_dir()
+    _create_test_model(model_path, 32)
+    with mock.patch.object(
+        inference_lib.multi_process_shared, 'MultiProcessShared', _UnsharedModel
+    ), mock.patch.object(
+        inference_lib, '_compile_for_input', autospec=True
+    ) as compile_for_input:
+      model = inference_lib.TF2InferenceModel(
+          model_path, 32, False, [], batch_size=4, jit_compile=False
+      )
+      model.prepare_model()
+      self.addCleanup(model.release_model)
+      examples = [_create_test_example(32, True) for _ in range(3)]
+      self.assertEqual(model.predict_scores(examples).shape, (3,))
+    compile_for_input.assert_not_called()
+
+  def test_quantize_model(self):
+    model_path = _make_temp_dir()
+    _create_test_model(model_path, 32)
+    rng = np.random.default_rng(0)
+    examples = []
+    for _ in range(10):
+      example = tf.train.Example()
+      for feature in inference_lib._IMAGE_FEATURES:
+        image = rng.integers(0, 256, size=(32, 32, 3), dtype=np.uint8)
+        utils.add_bytes_feature(
+            feature, tf.image.encode_png(image).numpy(), example
+        )
+      examples.append(example)
+
+    quantized_model_path = inference_lib.quantize_model(
+        model_path, examples, 32, False
+    )
+    self.assertEqual(
+        quantized_model_path, inference_lib.get_quantized_model_path(model_path)
+    )
+
+    image_reader = inference_lib.TF2InferenceModel(model_path, 32, False, [])
+    model_input = image_reader._extract_image_arrays(examples)
+    expected = tf.saved_model.load(model_path)(model_input)['main']
+    actual = inference_lib.TFLiteModel(quantized_model_path)(model_input)
+    self.assertEqual(actual['main'].shape, (10, 2))
+    np.testing.assert_allclose(actual['main'], expected, atol=0.1)
+
+  def test_convert_with_tensorrt_falls_back_without_gpu(self):
+    if tf.config.list_physical_devices('GPU'):
+      self.skipTest('Test requires a machine without GPUs.')
+    model_path = _make_temp_dir()
+    _create_test_model(model_path, 32)
+    model_input = {
+        'small_image': np.zeros((2, 32, 32, 6), dtype=np.float32),
+        'large_image': np.zeros((2, 32, 32, 6), dtype=np.float32),
+    }
+    self.assertIsNone(
+        inference_lib._convert_with_tensorrt(model_path, model_input)
+    )
+
+  def test_decode_pool_is_shared_and_shut_down(self):
+    pool = inference_lib._acquire_decode_pool()
+    self.assertIs(inference_lib._acquire_decode_pool(), pool)
+    self.assertLessEqual(pool._max_workers, inference_lib._MAX_DECODE_THREADS)
+    inference_lib._release_decode_pool()
+    self.assertEqual(pool.submit(int, '1').result(), 1)
+    inference_lib._release_decode_pool()
+    with self.assertRaises(RuntimeError):
+      pool.submit(int, '1')
+    self.assertIsNot(inference_lib._acquire_decode_pool(), pool)
+    inference_lib._release_decode_pool()
+
+  def test_import_does_not_import_tensorflow_text(self):
+    # Run in a new interpreter, since this test module may already have
+    # imported tensorflow_text.
+    subprocess.run(
+        [
+            sys.executable,
+            '-c',
+            'import sys\n'
+            'from skai.model import inference_lib\n'
+            'assert "tensorflow_text" not in sys.modules',
+        ],
+        check=True,
+        env={**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)},
+    )
+
+  def test_compile_for_input(self):
+    def model(batch):
+      return {'main': tf.reduce_sum(batch['small_image'], axis=[1, 2, 3])}
+
+    model_input = {'small_image': np.ones((2, 4, 4, 3), dtype=np.float32)}
+    compiled_model = inference_lib._compile_for_input(model, model_input)
+    self.assertIsNot(compiled_model, model)
+    np.testing.assert_allclose(compiled_model(model_input)['main'], [48, 48])
+
+  def test_compile_for_input_falls_back_to_model(self):
+    def model(batch):
+      # String ops can't be compiled with XLA.
+      return {'main': tf.strings.as_string(batch['small_image'])}
+
+    model_input = {'small_image': np.ones((2, 4, 4, 3), dtype=np.float32)}
+    self.assertIs(inference_lib._compile_for_input(model, model_input), model)
+
+  def test_decode_and_resize_image_matches_tf(self):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(64, 64, 3), dtype=np.uint8)
+    for image_bytes in [
+        tf.image.encode_png(image).numpy(),
+        tf.image.encode_jpeg(image).numpy(),
+    ]:
+      for image_size in [32, 64, 224]:
+        np.testing.assert_allclose(
+            inference_lib._decode_and_resize_image(image_bytes, image_size),
+            data.decode_and_resize_image(image_bytes, image_size).numpy(),
+            atol=1e-5,
+        )
+
+  def test_decode_and_resize_image_into_output(self):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(64, 64, 3), dtype=np.uint8)
+    image_bytes = tf.image.encode_png(image).numpy()
+    for image_size in [32, 64]:
+      out = np.zeros((image_size, image_size, 6), dtype=np.float32)
+      result = inference_lib._decode_and_resize_image(
+          image_bytes, image_size, out[..., 3:]
+      )
+      np.testing.assert_array_equal(out[..., :3], 0)
+      np.testing.assert_array_equal(
+          out[..., 3:],
+          inference_lib._decode_and_resize_image(image_bytes, image_size),
+      )
+      self.assertTrue(np.shares_memory(result, out))
+
 
 if __name__ == '__main__':
   absltest.main()
@@ -0,0 +1,46 @@
+"""Exports an int8 quantized version of a TF2 model for inference.
+
+The export is written to the "int8" subdirectory of the model directory, where
+it is picked up automatically by inference_lib.TF2InferenceModel. To go back to
+full precision inference, delete that subdirectory.
+"""
+
+from absl import app
+from absl import flags
+from absl import logging
+from skai.model import inference_lib
+import tensorflow as tf
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    'examples_pattern',
+    None,
+    'File pattern for TFRecords of examples used for calibration.',
+    required=True,
+)
+flags.DEFINE_string('model_dir', None, 'Saved model directory.', required=True)
+flags.DEFINE_integer('image_size', 224, 'Expected image width and height.')
+flags.DEFINE_bool('post_images_only', False, 'Model expects only post images')
+flags.DEFINE_integer(
+    'num_calibration_examples', 200, 'Number of examples used for calibration.'
+)
+
+
+def main(_) -> None:
+  examples = [
+      tf.train.Example.FromString(record)
+      for record in tf.data.TFRecordDataset(
+          tf.io.gfile.glob(FLAGS.examples_pattern)
+      )
+      .take(FLAGS.num_calibration_examples)
+      .as_numpy_iterator()
+  ]
+  model_path = inference_lib.quantize_model(
+      FLAGS.model_dir, examples, FLAGS.image_size, FLAGS.post_images_only
+  )
+  logging.info('Wrote quantized model to %s', model_path)
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -22,6 +22,8 @@ import numpy as np
 import tensorflow.compat.v1 as tf
 
 _GPUS = None
+_NUM_GPUS = None
+_CHECKPOINT_STEP_RE = re.compile(r'.*model\.ckpt-(?P<step>\d+)\.meta')
 
 
 class EasyDict(dict):
@@ -33,7 +35,7 @@ class EasyDict(dict):
 
 def get_config():
   config = tf.ConfigProto()
-  if len(get_available_gpus()) > 1:
+  if _num_gpus() > 1:
     config.allow_soft_placement = True
   config.gpu_options.allow_growth = True
   return config
@@ -67,12 +69,20 @@ def find_latest_checkpoint(folder):
 
   Returns:
     string, file name of the latest checkpoint.
+
+  Raises:
+    ValueError: If the directory contains no checkpoints.
   """
-  r_step = re.compile(r'.*model\.ckpt-(?P<step>\d+)\.meta')
-  matches = tf.gfile.Glob(os.path.join(folder, 'model.ckpt-*.meta'))
-  matches = [(int(r_step.match(x).group('step')), x) for x in matches]
-  ckpt_file = max(matches)[1][:-5]
-  return ckpt_file
+  latest_step, latest_meta_file = -1, None
+  for x in tf.gfile.Glob(os.path.join(folder, 'model.ckpt-*.meta')):
+    match = _CHECKPOINT_STEP_RE.match(x)
+    if match:
+      step = int(match.group('step'))
+      if step > latest_step:
+        latest_step, latest_meta_file = step, x
+  if latest_meta_file is None:
+    raise ValueError(f'No checkpoints found in {folder}.')
+  return latest_meta_file[:-5]
 
 
 def get_latest_global_step(folder):
@@ -133,7 +143,7 @@ def model_vars(scope=None):
 
 
 def gpu(x):
-  return '/gpu:%d' % (x % max(1, len(get_available_gpus())))
+  return '/gpu:%d' % (x % max(1, _num_gpus()))
 
 
 def get_available_gpus():
@@ -146,6 +156,14 @@ def get_available_gpus():
   return _GPUS
 
 
+def _num_gpus():
+  """Returns the number of available GPUs, cached after the first call."""
+  global _NUM_GPUS
+  if _NUM_GPUS is None:
+    _NUM_GPUS = len(get_available_gpus())
+  return _NUM_GPUS
+
+
 def average_gradients(tower_grads):
   """Calculate the average gradient for each shared variable across all towers.
 
@@ -162,18 +180,26 @@ def average_gradients(tower_grads):
   if len(tower_grads) <= 1:
     return tower_grads[0]
 
+  # Summing with add_n avoids stacking the tower gradients into one tensor.
+  scale = 1.0 / len(tower_grads)
   average_grads = []
   for grads_and_vars in zip(*tower_grads):
-    grad = tf.reduce_mean([gv[0] for gv in grads_and_vars], 0)
+    grad = tf.add_n([gv[0] for gv in grads_and_vars]) * scale
     average_grads.append((grad, grads_and_vars[0][1]))
   return average_grads
 
 
-def para_list(fn, *args):
-  """Run on multiple GPUs in parallel and return list of results."""
-  gpus = len(get_available_gpus())
-  if gpus <= 1:
-    return zip(*[fn(*args)])
+def _run_on_towers(fn, args):
+  """Splits args across GPUs and runs fn on each split in its own tower.
+
+  Args:
+    fn: function to run on each tower.
+    args: tensors to split along their first dimension, one split per GPU.
+
+  Returns:
+    List of the outputs of fn, one per GPU.
+  """
+  gpus = _num_gpus()
   splitted = [tf.split(x, gpus) for x in args]
   outputs = []
   for gpu_id, x in enumerate(zip(*splitted)):
@@ -183,23 +209,21 @@ def para_list(fn, *args):
               worker_device='/gpu:%d' % gpu_id, ps_device='/cpu:0',
               ps_tasks=1)):
         outputs.append(fn(*x))
-  return zip(*outputs)
+  return outputs
+
+
+def para_list(fn, *args):
+  """Run on multiple GPUs in parallel and return list of results."""
+  if _num_gpus() <= 1:
+    return zip(*[fn(*args)])
+  return zip(*_run_on_towers(fn, args))
 
 
 def para_mean(fn, *args):
   """Run on multiple GPUs in parallel and return means."""
-  gpus = len(get_available_gpus())
-  if gpus <= 1:
+  if _num_gpus() <= 1:
     return fn(*args)
-  splitted = [tf.split(x, gpus) for x in args]
-  outputs = []
-  for gpu_id, x in enumerate(zip(*splitted)):
-    with tf.name_scope('tower%d' % gpu_id):
-      with tf.device(
-          tf.train.replica_device_setter(
-              worker_device='/gpu:%d' % gpu_id, ps_device='/cpu:0',
-              ps_tasks=1)):
-        outputs.append(fn(*x))
+  outputs = _run_on_towers(fn, args)
   if isinstance(outputs[0], (tuple, list)):
     return [tf.reduce_mean(x, 0) for x in zip(*outputs)]
   return tf.reduce_mean(outputs, 0)
@@ -207,18 +231,9 @@ def para_mean(fn, *args):
 
 def para_cat(fn, *args):
   """Run on multiple GPUs in parallel and return concatenated outputs."""
-  gpus = len(get_available_gpus())
-  if gpus <= 1:
+  if _num_gpus() <= 1:
     return fn(*args)
-  splitted = [tf.split(x, gpus) for x in args]
-  outputs = []
-  for gpu_id, x in enumerate(zip(*splitted)):
-    with tf.name_scope('tower%d' % gpu_id):
-      with tf.device(
-          tf.train.replica_device_setter(
-              worker_device='/gpu:%d' % gpu_id, ps_device='/cpu:0',
-              ps_tasks=1)):
-        outputs.append(fn(*x))
+  outputs = _run_on_towers(fn, args)
   if isinstance(outputs[0], (tuple, list)):
     return [tf.concat(x, axis=0) for x in zip(*outputs)]
   return tf.concat(outputs, axis=0)